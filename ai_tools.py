@@ -382,6 +382,20 @@ async def create_delivery_request(api_request_func, client_id: int, company_id:
 # --- 2. ФУНКЦИИ-ОБРАБОТЧИКИ (ПОЛНАЯ ПЕРЕПИСЬ) ---
 # =================================================================
 
+async def lookup_tracks(api_request_func, employee_id, company_id, track_codes: List[str]) -> Dict[str, dict]:
+    """
+    Находит заказы по списку трек-кодов ОДНИМ запросом (POST /api/orders/lookup_tracks).
+    Возвращает {трек-код из запроса: заказ}, ненайденных треков в словаре нет.
+    """
+    response = await api_request_func("POST", "/api/orders/lookup_tracks", employee_id=employee_id, json={
+        "track_codes": track_codes, "company_id": company_id
+    })
+    if not response or "error" in response:
+        logger.error(f"[Lookup Tracks] Ошибка поиска треков: {response}")
+        return {}
+    return {hit['query']: hit for hit in response.get('found', [])}
+
+
 async def update_orders_by_tracks(api_request_func, employee_id, company_id, track_codes, new_status):
     """
     Инструмент: Ищет заказы по трек-кодам и готовит кнопку для смены статуса.
@@ -400,12 +414,11 @@ async def update_orders_by_tracks(api_request_func, employee_id, company_id, tra
         client_names = []
         found_tracks_str = []
         
-        # 2. Ищем каждый заказ
+        # 2. Ищем все заказы одним запросом (трек уникален в рамках компании)
+        found_orders = await lookup_tracks(api_request_func, employee_id, company_id, clean_tracks)
         for track in clean_tracks:
-            # Ищем заказ (limit=1, так как трек уникален в рамках компании)
-            orders = await api_request_func("GET", "/api/orders", employee_id=employee_id, params={"q": track, "company_id": company_id, "limit": 1})
-            if orders:
-                order = orders[0]
+            order = found_orders.get(track)
+            if order:
                 found_ids.append(order['id'])
                 found_tracks_str.append(order['track_code'])
                 
@@ -680,43 +693,41 @@ async def execute_ai_tool(tool_command: dict, api_request_func, company_id: int,
             return text
 
         elif tool == "update_order_status":
-            track = tool_command.get("track_code")
+            track = (tool_command.get("track_code") or "").strip() # Поиск ищет по очищенному треку и возвращает его же как ключ
             status = tool_command.get("new_status")
-            orders = await api_request_func("GET", "/api/orders", employee_id=employee_id, params={"q": track, "company_id": company_id, "limit": 1})
-            if not orders: return f"❌ Заказ `{track}` не найден."
+            order = (await lookup_tracks(api_request_func, employee_id, company_id, [track])).get(track) if track else None
+            if not order: return f"❌ Заказ `{track}` не найден."
             return json.dumps({
-                "confirm_action": "update_single", "order_id": orders[0]['id'], "track": track, "new_status": status,
+                "confirm_action": "update_single", "order_id": order['id'], "track": track, "new_status": status,
                 "message": f"❓ Изменить статус заказа `{track}` на **{status}**?"
             })
 
         elif tool == "delete_order":
-            track = tool_command.get("track_code")
+            track = (tool_command.get("track_code") or "").strip()
             if not track: return "❌ Ошибка: Не указан трек-код."
 
             # Сначала ищем заказ, чтобы узнать его ID
-            orders = await api_request_func("GET", "/api/orders", employee_id=employee_id, params={"q": track, "company_id": company_id, "limit": 1})
-            
-            if not orders: return f"❌ Заказ `{track}` не найден."
+            order = (await lookup_tracks(api_request_func, employee_id, company_id, [track])).get(track)
             
-            order = orders[0]
+            if not order: return f"❌ Заказ `{track}` не найден."
             
             # Возвращаем кнопку подтверждения
             return json.dumps({
                 "confirm_action": "delete_order", 
                 "order_id": order['id'], 
                 "track": track,
-                "message": f"🗑 **УДАЛЕНИЕ ЗАКАЗА**\nТрек: `{track}`\nКлиент: {order.get('client', {}).get('full_name', 'Неизвестно')}\n\nВы уверены? Это необратимо."
+                "message": f"🗑 **УДАЛЕНИЕ ЗАКАЗА**\nТрек: `{track}`\nКлиент: {(order.get('client') or {}).get('full_name', 'Неизвестно')}\n\nВы уверены? Это необратимо."
             }, ensure_ascii=False)
 
         elif tool == "assign_client":
-            track = tool_command.get("track_code")
+            track = (tool_command.get("track_code") or "").strip()
             c_query = tool_command.get("client_search")
             clients = await api_request_func("GET", "/api/clients/search", employee_id=employee_id, params={"q": c_query, "company_id": company_id})
             if not clients: return f"❌ Клиент '{c_query}' не найден."
-            orders = await api_request_func("GET", "/api/orders", employee_id=employee_id, params={"q": track, "company_id": company_id, "limit": 1})
-            if not orders: return f"❌ Заказ `{track}` не найден."
+            order = (await lookup_tracks(api_request_func, employee_id, company_id, [track])).get(track) if track else None
+            if not order: return f"❌ Заказ `{track}` не найден."
             return json.dumps({
-                "confirm_action": "assign_client", "order_id": orders[0]['id'], "track": track, "client_id": clients[0]['id'], "client_name": clients[0]['full_name'],
+                "confirm_action": "assign_client", "order_id": order['id'], "track": track, "client_id": clients[0]['id'], "client_name": clients[0]['full_name'],
                 "message": f"❓ Присвоить заказ `{track}` клиенту **{clients[0]['full_name']}**?"
             })
 
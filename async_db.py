@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# async_db.py
+# Асинхронный доступ к БД (SQLAlchemy AsyncSession + asyncpg).
+#
+# Зачем: синхронная Session внутри async def блокирует event loop - пока идет запрос к БД,
+# стоят ВСЕ остальные запросы процесса (и отправка уведомлений в воркере).
+# Порядок перехода:
+#   - уведомления, рассылки и их эндпоинты работают через AsyncSession (этот модуль);
+#   - остальные эндпоинты пока синхронные (def + get_db): FastAPI выполняет их в пуле потоков,
+#     и они переводятся по одному.
+#
+# Движок создается на каждый event loop: соединения asyncpg привязаны к loop, в котором открыты
+# (тот же прием, что и в telegram_delivery.get_delivery_queue).
+# Требуются пакеты asyncpg и greenlet (pip install asyncpg greenlet).
+
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from request_metrics import instrument_engine, timed_pool_class
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# --- НАСТРОЙКИ ---
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "10"))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "20"))
+
+
+def make_async_database_url(url: str) -> str:
+    """
+    postgresql:// или postgresql+psycopg2:// -> postgresql+asyncpg://.
+    sslmode (параметр libpq) asyncpg не понимает - переносим его в ssl.
+    """
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "postgresql":
+        raise RuntimeError(f"Асинхронный доступ поддерживается только для PostgreSQL, а не {parsed.get_backend_name()}")
+    query = dict(parsed.query)
+    if "sslmode" in query:
+        query["ssl"] = query.pop("sslmode")
+    return parsed.set(drivername="postgresql+asyncpg", query=query).render_as_string(hide_password=False)
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or (
+    make_async_database_url(os.environ["DATABASE_URL"]) if os.getenv("DATABASE_URL") else None
+)
+
+# --- ДВИЖКИ ПО EVENT LOOP ---
+_TimedAsyncPool = timed_pool_class(AsyncAdaptedQueuePool, "async") # Замер ожидания соединения (request_metrics)
+_engines: Dict[asyncio.AbstractEventLoop, Tuple[AsyncEngine, async_sessionmaker]] = {}
+
+
+def _get_sessionmaker() -> async_sessionmaker:
+    if not ASYNC_DATABASE_URL:
+        raise RuntimeError("Не найден ключ DATABASE_URL в файле .env")
+    loop = asyncio.get_running_loop()
+    entry = _engines.get(loop)
+    if entry is None:
+        # Движки закрытых loop-ов (например, после TestClient) больше не нужны
+        for old_loop in [l for l in _engines if l.is_closed()]:
+            _engines.pop(old_loop)
+        engine = create_async_engine(
+            ASYNC_DATABASE_URL,
+            poolclass=_TimedAsyncPool,
+            pool_recycle=1800,
+            pool_pre_ping=True,
+            pool_size=ASYNC_DB_POOL_SIZE,
+            max_overflow=ASYNC_DB_MAX_OVERFLOW,
+        )
+        instrument_engine(engine.sync_engine, "async")
+        # expire_on_commit=False: после commit объекты можно читать без нового запроса (ленивая загрузка в async запрещена)
+        entry = (engine, async_sessionmaker(engine, expire_on_commit=False, autoflush=False))
+        _engines[loop] = entry
+    return entry[1]
+
+
+def get_async_engine() -> AsyncEngine:
+    _get_sessionmaker()
+    return _engines[asyncio.get_running_loop()][0]
+
+
+@asynccontextmanager
+async def async_session() -> AsyncIterator[AsyncSession]:
+    """Сессия для фоновых задач: async with async_session() as db: ..."""
+    session = _get_sessionmaker()()
+    try:
+        yield session
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    """Зависимость FastAPI для async-эндпоинтов (аналог get_db)."""
+    async with async_session() as session:
+        yield session
+
+
+async def dispose_async_engine() -> None:
+    """Закрывает пул текущего event loop (при остановке приложения/воркера)."""
+    entry = _engines.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        await entry[0].dispose()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# bot_host.py
+# Один процесс для ботов ВСЕХ компаний (вместо отдельного bot_template.py на компанию).
+#
+# Зачем: manage_bots.py писал конфиг Supervisor на каждую компанию, и каждый бот был отдельным
+# интерпретатором Python со своими клиентами ИИ, HTTP-пулами и памятью.
+# Здесь:
+#   - на каждую компанию свой Application (обработчики из bot_template.build_application);
+#   - HTTP-пулы к Telegram, клиент к ADMIN_API_URL и клиенты ИИ - общие на весь процесс;
+#   - компании берутся из таблицы companies одним запросом и перечитываются каждые
+#     BOT_HOST_REFRESH_SECONDS (или сразу по SIGHUP): новые боты запускаются, удаленные/отключенные
+#     останавливаются без перезагрузки Supervisor.
+#
+# Запуск (одна программа Supervisor вместо cargo_bot_<КОД>, см. manage_bots.py --host):
+#   python bot_host.py          - long polling (по соединению getUpdates на бота)
+#   python bot_webhook.py       - webhook: Telegram сам присылает апдейты на один порт (см. bot_webhook.py)
+
+import os
+import asyncio
+import hashlib
+import hmac
+import logging
+import signal
+from dataclasses import dataclass
+from time import monotonic
+from typing import Dict, Optional
+
+from sqlalchemy import text
+from telegram import Update
+from telegram.error import Forbidden, InvalidToken
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+import bot_template
+from bot_template import BotTenant, build_application, close_api_client, configure_api_client
+from async_db import async_session, dispose_async_engine
+from telegram_delivery import TG_API_BASE_URL, TG_API_FILE_URL
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ ---
+BOT_HOST_REFRESH_SECONDS = float(os.getenv("BOT_HOST_REFRESH_SECONDS", "30"))
+BOT_HOST_RETRY_SECONDS = float(os.getenv("BOT_HOST_RETRY_SECONDS", "300")) # Повтор запуска бота с ошибкой (неверный токен и т.п.)
+BOT_HOST_START_CONCURRENCY = int(os.getenv("BOT_HOST_START_CONCURRENCY", "10")) # Сколько ботов запускаем одновременно
+BOT_HOST_POOL_SIZE = int(os.getenv("BOT_HOST_POOL_SIZE", "256")) # Общий пул соединений для отправки
+BOT_HOST_MAX_BOTS = int(os.getenv("BOT_HOST_MAX_BOTS", "500")) # Long polling держит по соединению на бота
+# Клиент к ADMIN_API_URL один на все боты процесса: 20 соединений по умолчанию из bot_template мало
+BOT_HOST_API_MAX_CONNECTIONS = int(os.getenv("BOT_HOST_API_MAX_CONNECTIONS", "200"))
+BOT_HOST_API_MAX_KEEPALIVE = int(os.getenv("BOT_HOST_API_MAX_KEEPALIVE", "100"))
+
+ACTIVE_BOTS_SQL = text("""
+    SELECT id, name, telegram_bot_token
+    FROM companies
+    WHERE is_active IS TRUE AND telegram_bot_token IS NOT NULL AND telegram_bot_token <> ''
+    ORDER BY id
+""")
+
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """
+    HTTPXRequest, общий для многих Bot: остановка одного бота (Bot.shutdown) не закрывает пул остальных.
+    Закрывается один раз через close() при остановке хоста.
+    """
+
+    async def shutdown(self) -> None:
+        return
+
+    async def close(self) -> None:
+        await super().shutdown()
+
+
+@dataclass
+class HostedBot:
+    tenant: BotTenant
+    application: Application
+    route_key: str = "" # Часть пути webhook (только в режиме webhook)
+    webhook_secret: str = "" # Ожидаемый X-Telegram-Bot-Api-Secret-Token
+
+
+def webhook_route_key(token: str) -> str:
+    """Путь webhook бота: хеш токена (сам токен в URL попал бы в логи прокси)."""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+def webhook_secret_for(token: str, secret: str) -> str:
+    """secret_token для setWebhook: свой у каждого бота, проверяется в bot_webhook.py."""
+    return hmac.new(secret.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+class BotHost:
+    """
+    Запускает, обновляет и останавливает Application ботов по таблице companies.
+    webhook_url задан - режим webhook: боты не опрашивают Telegram, а апдейты приходят
+    на {webhook_url}/{route_key} (их принимает bot_webhook.py и передает в routes).
+    """
+
+    def __init__(self, webhook_url: Optional[str] = None, webhook_secret: Optional[str] = None):
+        self.bots: Dict[str, HostedBot] = {} # token -> бот
+        self.routes: Dict[str, HostedBot] = {} # route_key -> бот (режим webhook)
+        self.failed: Dict[str, float] = {} # token -> когда можно повторить запуск
+        self.refresh_event = asyncio.Event()
+        self.webhook_url = webhook_url.rstrip("/") if webhook_url else None
+        self.webhook_secret = webhook_secret or ""
+        self.request = SharedHTTPXRequest(connection_pool_size=BOT_HOST_POOL_SIZE)
+        # getUpdates висит до 10 сек (long polling) - отдельный пул, чтобы не занимать соединения отправки
+        self.get_updates_request = None if self.webhook_url else SharedHTTPXRequest(connection_pool_size=BOT_HOST_MAX_BOTS)
+        self._start_semaphore = asyncio.Semaphore(BOT_HOST_START_CONCURRENCY)
+        configure_api_client(BOT_HOST_API_MAX_CONNECTIONS, BOT_HOST_API_MAX_KEEPALIVE)
+
+    # --- КОМПАНИИ ---
+    async def load_tenants(self) -> Dict[str, BotTenant]:
+        async with async_session() as db:
+            rows = (await db.execute(ACTIVE_BOTS_SQL)).all()
+        tenants = {}
+        for row in rows:
+            token = row.telegram_bot_token.strip()
+            if token in tenants:
+                logger.warning(f"[BotHost] Один токен у компаний {tenants[token].company_id} и {row.id} - пропускаем вторую.")
+                continue
+            tenants[token] = BotTenant(token=token, company_id=row.id, company_name=row.name)
+        return tenants
+
+    async def sync(self) -> None:
+        """Приводит запущенных ботов в соответствие с таблицей companies."""
+        tenants = await self.load_tenants()
+
+        removed = [token for token in self.bots if token not in tenants]
+        await asyncio.gather(*(self.stop_bot(token, delete_webhook=True) for token in removed))
+        for token in list(self.failed):
+            if token not in tenants:
+                self.failed.pop(token)
+
+        now = monotonic()
+        to_start = []
+        for token, tenant in tenants.items():
+            hosted = self.bots.get(token)
+            if hosted is not None:
+                # Тот же токен: обновляем данные компании на месте, без перезапуска
+                hosted.tenant.company_id = tenant.company_id
+                hosted.tenant.company_name = tenant.company_name
+            elif self.failed.get(token, 0) <= now:
+                to_start.append(tenant)
+        await asyncio.gather(*(self.start_bot(tenant) for tenant in to_start))
+
+        if removed or to_start:
+            logger.info(f"[BotHost] Ботов запущено: {len(self.bots)}, с ошибкой: {len(self.failed)}, "
+                        f"добавлено: {len(to_start)}, остановлено: {len(removed)}")
+
+    # --- ЗАПУСК / ОСТАНОВКА ---
+    def make_builder(self, tenant: BotTenant):
+        builder = (
+            Application.builder()
+            .token(tenant.token)
+            .base_url(TG_API_BASE_URL)
+            .base_file_url(TG_API_FILE_URL)
+            .request(self.request)
+            .job_queue(None) # Обработчики бота JobQueue не используют, а это свой планировщик на каждого
+        )
+        if self.webhook_url:
+            return builder.updater(None) # Апдейты приносит bot_webhook.py
+        return builder.get_updates_request(self.get_updates_request)
+
+    async def start_bot(self, tenant: BotTenant) -> None:
+        async with self._start_semaphore:
+            application = build_application(tenant, self.make_builder(tenant))
+            hosted = HostedBot(tenant=tenant, application=application)
+            try:
+                await application.initialize() # getMe: заодно проверяет токен
+                await application.start()
+                if self.webhook_url:
+                    hosted.route_key = webhook_route_key(tenant.token)
+                    hosted.webhook_secret = webhook_secret_for(tenant.token, self.webhook_secret)
+                    # Маршрут регистрируем до setWebhook: Telegram может прислать апдейт сразу
+                    self.routes[hosted.route_key] = hosted
+                    await application.bot.set_webhook(
+                        url=f"{self.webhook_url}/{hosted.route_key}",
+                        secret_token=hosted.webhook_secret,
+                        allowed_updates=Update.ALL_TYPES,
+                    )
+                else:
+                    await application.updater.start_polling()
+            except (InvalidToken, Forbidden) as e:
+                logger.error(f"[BotHost] Компания {tenant.company_id} ({tenant.company_name}): неверный токен бота: {e}")
+                self.routes.pop(hosted.route_key, None)
+                await self._shutdown_application(application)
+                self.failed[tenant.token] = monotonic() + BOT_HOST_RETRY_SECONDS
+                return
+            except Exception as e:
+                logger.error(f"[BotHost] Компания {tenant.company_id}: бот не запустился: {e}", exc_info=True)
+                self.routes.pop(hosted.route_key, None)
+                await self._shutdown_application(application)
+                self.failed[tenant.token] = monotonic() + BOT_HOST_RETRY_SECONDS
+                return
+            self.failed.pop(tenant.token, None)
+            self.bots[tenant.token] = hosted
+            logger.info(f"[BotHost] Бот компании '{tenant.company_name}' (ID: {tenant.company_id}) запущен.")
+
+    async def stop_bot(self, token: str, delete_webhook: bool = False) -> None:
+        """
+        delete_webhook=True - компания удалена/отключена: снимаем webhook в Telegram.
+        При обычной остановке хоста webhook остается, и Telegram копит апдейты до перезапуска.
+        """
+        hosted = self.bots.pop(token, None)
+        if hosted is None:
+            return
+        self.routes.pop(hosted.route_key, None)
+        if delete_webhook and hosted.route_key:
+            try:
+                await hosted.application.bot.delete_webhook()
+            except Exception as e:
+                logger.warning(f"[BotHost] Не удалось снять webhook компании {hosted.tenant.company_id}: {e}")
+        await self._shutdown_application(hosted.application)
+        logger.info(f"[BotHost] Бот компании '{hosted.tenant.company_name}' (ID: {hosted.tenant.company_id}) остановлен.")
+
+    @staticmethod
+    async def _shutdown_application(application: Application) -> None:
+        try:
+            if application.updater is not None and application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+        except Exception as e:
+            logger.error(f"[BotHost] Ошибка остановки бота: {e}")
+
+    # --- ОСНОВНОЙ ЦИКЛ ---
+    async def run(self, stop_event: asyncio.Event) -> None:
+        logger.info("[BotHost] Запуск хоста ботов...")
+        try:
+            while not stop_event.is_set():
+                try:
+                    await self.sync()
+                except Exception as e:
+                    logger.error(f"[BotHost] Ошибка синхронизации со списком компаний: {e}", exc_info=True)
+
+                self.refresh_event.clear()
+                waiters = [asyncio.ensure_future(stop_event.wait()), asyncio.ensure_future(self.refresh_event.wait())]
+                await asyncio.wait(waiters, timeout=BOT_HOST_REFRESH_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        await asyncio.gather(*(self.stop_bot(token) for token in list(self.bots)))
+        await self.request.close()
+        if self.get_updates_request is not None:
+            await self.get_updates_request.close()
+        await close_api_client()
+        await dispose_async_engine()
+        logger.info("[BotHost] Хост ботов остановлен.")
+
+
+async def _main() -> None:
+    if not bot_template.ADMIN_API_URL:
+        logger.critical("Не найдена переменная окружения ADMIN_API_URL.")
+        raise SystemExit(1)
+    host = BotHost()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = [(signal.SIGINT, stop_event.set), (signal.SIGTERM, stop_event.set)]
+    if hasattr(signal, "SIGHUP"):
+        signals.append((signal.SIGHUP, host.refresh_event.set)) # kill -HUP: перечитать компании сразу
+    for sig, callback in signals:
+        try:
+            loop.add_signal_handler(sig, callback)
+        except NotImplementedError: # Windows
+            pass
+    await host.run(stop_event)
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
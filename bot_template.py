@@ -10,8 +10,11 @@ import sys  # Для sys.exit()
 import logging
 import asyncio
 import html # Для форматирования ответов
+import time # Для замера задержек API
 import asyncio
 from typing import Optional, Dict, Any, List
+from dataclasses import dataclass, field
+from contextvars import ContextVar
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta, date
 import json # <-- Добавляем json
@@ -22,6 +25,8 @@ import openpyxl
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
+    TypeHandler,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -55,18 +60,40 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 # DATABASE_URL = os.getenv("DATABASE_URL") # <-- Больше не нужен
 ADMIN_API_URL = os.getenv('ADMIN_API_URL')
 
-# --- Глобальные переменные для ID компании ---
-# Они будут установлены при запуске функцией identify_bot_company()
-COMPANY_ID_FOR_BOT: int = 0
-COMPANY_NAME_FOR_BOT: str = "Неизвестная компания"
+# --- Компания бота (BotTenant) ---
+# Раньше это были глобальные COMPANY_ID_FOR_BOT / COMPANY_NAME_FOR_BOT: один процесс = один бот.
+# Теперь в одном процессе может работать много ботов (bot_host.py), поэтому компания текущего
+# апдейта лежит в contextvar. Его ставит обработчик bind_tenant (группа -100) из application.bot_data.
+@dataclass
+class BotTenant:
+    token: str
+    company_id: int
+    company_name: str = "Неизвестная компания"
+    # Последний ответ AI-Рубильника и его ETag (у каждой компании свой)
+    ai_enabled_cache: Dict[str, Any] = field(default_factory=lambda: {"etag": None, "value": False})
 
-# Проверка, что все переменные окружения заданы
-if not TELEGRAM_BOT_TOKEN or not ADMIN_API_URL: # <-- Убрали DATABASE_URL
-    logger.critical("="*50)
-    logger.critical("КРИТИЧЕСКАЯ ОШИБКА: bot_template.py")
-    logger.critical("Не найдены переменные окружения: TELEGRAM_BOT_TOKEN или ADMIN_API_URL.")
-    logger.critical("="*50)
-    sys.exit(1)
+
+_current_tenant: ContextVar[Optional[BotTenant]] = ContextVar("bot_tenant", default=None)
+
+
+def current_tenant() -> BotTenant:
+    tenant = _current_tenant.get()
+    if tenant is None:
+        raise RuntimeError("Апдейт не привязан к компании (нет BotTenant в контексте).")
+    return tenant
+
+
+def company_id_for_bot() -> int:
+    return current_tenant().company_id
+
+
+def company_name_for_bot() -> str:
+    return current_tenant().company_name
+
+
+async def bind_tenant(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Группа -100: все следующие обработчики апдейта (и их задачи) видят компанию своего бота."""
+    _current_tenant.set(context.bot_data["tenant"])
 
 # --- Настройка подключения к базе данных ---
 # engine = create_engine(DATABASE_URL, pool_recycle=1800, pool_pre_ping=True) # <-- Больше не нужен
@@ -144,6 +171,128 @@ def normalize_phone_number(phone_str: str) -> str:
 #     """..."""
 #     return db.query(Client).filter(Client.telegram_chat_id == str(user_id)).first()
 
+# --- ОБЩИЙ HTTP-КЛИЕНТ ДЛЯ API (keep-alive) ---
+# Раньше на каждый вызов api_request открывался новый httpx.AsyncClient (новое TCP/TLS-соединение).
+# Теперь один клиент на процесс бота: соединения к ADMIN_API_URL переиспользуются.
+# Лимит соединений настраивается через окружение; bot_host.py поднимает его (один клиент на все боты процесса)
+API_HTTP_MAX_CONNECTIONS = int(os.getenv("API_HTTP_MAX_CONNECTIONS", "20"))
+API_HTTP_MAX_KEEPALIVE = int(os.getenv("API_HTTP_MAX_KEEPALIVE", "10"))
+API_HTTP_LIMITS = httpx.Limits(max_connections=API_HTTP_MAX_CONNECTIONS, max_keepalive_connections=API_HTTP_MAX_KEEPALIVE, keepalive_expiry=30.0)
+API_DEFAULT_TIMEOUT = httpx.Timeout(15.0, connect=5.0)
+# Долгие эндпоинты (импорт Excel, массовые действия) - свои таймауты
+API_ENDPOINT_TIMEOUTS = {
+    "/api/orders/bulk_import": httpx.Timeout(120.0, connect=5.0),
+    "/api/bot/bulk_add_orders": httpx.Timeout(60.0, connect=5.0),
+    "/api/orders/bulk_action": httpx.Timeout(60.0, connect=5.0),
+    "/api/orders/calculate": httpx.Timeout(60.0, connect=5.0),
+    "/api/bot/settings": httpx.Timeout(5.0, connect=3.0), # Горячий путь: лучше быстро сдаться
+}
+API_METRICS_LOG_EVERY = 500 # Раз в N запросов пишем сводку задержек в лог
+API_METRICS_SAMPLES = 500   # Сколько последних замеров хранить на эндпоинт
+
+_api_client: Optional[httpx.AsyncClient] = None
+_api_client_loop = None
+_api_latency: Dict[str, Dict[str, Any]] = {}
+_api_calls_total = 0
+
+
+def _http2_available() -> bool:
+    """HTTP/2 включаем, только если установлен пакет h2 (pip install httpx[http2])."""
+    try:
+        import h2 # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _retire_api_client(client: Optional[httpx.AsyncClient], loop) -> None:
+    """
+    Прежний клиент из другого event loop. Его соединения привязаны к тому loop, поэтому aclose()
+    из текущего loop вызывать нельзя: если старый loop еще работает (в другом потоке) - закрываем
+    клиент на нем, иначе соединения уже мертвы и клиент просто отпускаем.
+    """
+    if client is None or client.is_closed:
+        return
+    if loop is not None and loop.is_running() and not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    else:
+        logger.info("[API] Event loop сменился: прежний HTTP-клиент отпущен вместе с остановленным loop.")
+
+
+def get_api_client() -> httpx.AsyncClient:
+    """Возвращает общий клиент (создает при первом обращении или если прежний закрыт/из другого loop)."""
+    global _api_client, _api_client_loop
+    loop = asyncio.get_running_loop()
+    if _api_client is None or _api_client.is_closed or _api_client_loop is not loop:
+        if _api_client_loop is not loop:
+            _retire_api_client(_api_client, _api_client_loop)
+        _api_client = httpx.AsyncClient(
+            timeout=API_DEFAULT_TIMEOUT,
+            limits=API_HTTP_LIMITS,
+            http2=_http2_available()
+        )
+        _api_client_loop = loop
+    return _api_client
+
+
+def configure_api_client(max_connections: int, max_keepalive_connections: int) -> None:
+    """Меняет лимиты пула к ADMIN_API_URL. Вызывать до первого запроса: уже созданный клиент не пересоздается."""
+    global API_HTTP_LIMITS
+    API_HTTP_LIMITS = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections, keepalive_expiry=30.0)
+
+
+async def close_api_client(application=None) -> None:
+    """Закрывает общий клиент (вызывается при остановке бота через post_shutdown)."""
+    global _api_client
+    log_api_latency_summary()
+    if _api_client is not None and not _api_client.is_closed:
+        await _api_client.aclose()
+    _api_client = None
+
+
+def _api_endpoint_key(method: str, endpoint: str) -> str:
+    """'/api/clients/15' -> 'GET /api/clients/{id}', чтобы метрики не дробились по ID."""
+    path = re.sub(r'/\d+', '/{id}', endpoint.split('?')[0])
+    return f"{method.upper()} {path}"
+
+
+def record_api_latency(key: str, elapsed_ms: float, ok: bool) -> None:
+    global _api_calls_total
+    stats = _api_latency.setdefault(key, {"count": 0, "errors": 0, "samples": []})
+    stats["count"] += 1
+    if not ok:
+        stats["errors"] += 1
+    samples = stats["samples"]
+    samples.append(elapsed_ms)
+    if len(samples) > API_METRICS_SAMPLES:
+        del samples[0]
+    _api_calls_total += 1
+    if _api_calls_total % API_METRICS_LOG_EVERY == 0:
+        log_api_latency_summary()
+
+
+def get_api_latency_summary() -> Dict[str, Dict[str, float]]:
+    """Сводка по эндпоинтам: число вызовов, ошибок и p50/p95/max по последним замерам (мс)."""
+    summary = {}
+    for key, stats in _api_latency.items():
+        samples = sorted(stats["samples"])
+        if not samples:
+            continue
+        summary[key] = {
+            "count": stats["count"],
+            "errors": stats["errors"],
+            "p50_ms": round(samples[len(samples) // 2], 1),
+            "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+            "max_ms": round(samples[-1], 1),
+        }
+    return summary
+
+
+def log_api_latency_summary() -> None:
+    for key, row in sorted(get_api_latency_summary().items(), key=lambda kv: -kv[1]["p95_ms"]):
+        logger.info(f"[API Metrics] {key}: n={row['count']} err={row['errors']} p50={row['p50_ms']}ms p95={row['p95_ms']}ms max={row['max_ms']}ms")
+# --- КОНЕЦ ОБЩЕГО HTTP-КЛИЕНТА ---
+
 # --- НОВАЯ ФУНКЦИЯ API REQUEST (Из v5.0) ---
 async def api_request(
     method: str, 
@@ -153,9 +302,9 @@ async def api_request(
 ) -> Optional[Dict[str, Any]]:
     """
     Универсальная асинхронная функция для отправки запросов к API бэкенда.
-    (ВЕРСИЯ 6.0 - с поддержкой X-Employee-ID и COMPANY_ID_FOR_BOT)
+    (ВЕРСИЯ 6.0 - с поддержкой X-Employee-ID и company_id текущего бота)
     """
-    global ADMIN_API_URL, COMPANY_ID_FOR_BOT
+    global ADMIN_API_URL
     if not ADMIN_API_URL:
         logger.error("ADMIN_API_URL не установлен! Невозможно выполнить API запрос.")
         return {"error": "URL API не настроен.", "status_code": 500}
@@ -164,43 +313,58 @@ async def api_request(
     
     params_dict = kwargs.pop('params', {}) 
     headers = kwargs.pop('headers', {'Content-Type': 'application/json'})
+    etag_store = kwargs.pop('etag_store', None) # dict, куда сохранить ETag ответа (для условных запросов)
 
     # Добавляем аутентификацию Владельца, если передан ID
     if employee_id:
         headers['X-Employee-ID'] = str(employee_id)
 
-    # --- ИЗМЕНЕНИЕ: Используем COMPANY_ID_FOR_BOT ---
+    # --- ИЗМЕНЕНИЕ: Используем company_id текущего бота ---
     if method.upper() == 'GET':
         if 'company_id' not in params_dict:
-            params_dict['company_id'] = COMPANY_ID_FOR_BOT
+            params_dict['company_id'] = company_id_for_bot()
         kwargs['params'] = params_dict
 
     elif method.upper() in ['POST', 'PATCH', 'PUT']:
         json_data = kwargs.get('json') 
         if json_data is not None: 
             if 'company_id' not in json_data:
-                json_data['company_id'] = COMPANY_ID_FOR_BOT
+                json_data['company_id'] = company_id_for_bot()
             kwargs['json'] = json_data
     # --- КОНЕЦ ИЗМЕНЕНИЯ ---
     
+    metrics_key = _api_endpoint_key(method, endpoint)
+    started = time.perf_counter()
+    request_ok = False
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client: 
-            logger.debug(f"API Request: {method} {url} | Headers: {headers} | Data/Params: {kwargs}")
-            response = await client.request(method, url, headers=headers, **kwargs)
-            logger.debug(f"API Response: {response.status_code} for {method} {url}")
-            response.raise_for_status()
+        client = get_api_client()
+        logger.debug(f"API Request: {method} {url} | Headers: {headers} | Data/Params: {kwargs}")
+        response = await client.request(
+            method, url, headers=headers,
+            timeout=API_ENDPOINT_TIMEOUTS.get(endpoint.split('?')[0], API_DEFAULT_TIMEOUT),
+            **kwargs
+        )
+        request_ok = response.status_code < 500
+        logger.debug(f"API Response: {response.status_code} for {method} {url}")
+        if response.status_code == 304:
+            # Условный запрос (If-None-Match): данные не изменились
+            return {"status": "not_modified"}
+        response.raise_for_status()
 
-            if response.status_code == 204:
-                return {"status": "ok"} 
+        if etag_store is not None and response.headers.get("ETag"):
+            etag_store["etag"] = response.headers["ETag"]
 
-            if response.content:
-                try:
-                    return response.json()
-                except Exception as json_err:
-                    logger.error(f"API Error: Failed to decode JSON from {url}. Status: {response.status_code}. Content: {response.text[:200]}...", exc_info=True)
-                    return {"error": "Ошибка чтения ответа от сервера.", "status_code": 500}
-            else:
-                return {"status": "ok"}
+        if response.status_code == 204:
+            return {"status": "ok"} 
+
+        if response.content:
+            try:
+                return response.json()
+            except Exception as json_err:
+                logger.error(f"API Error: Failed to decode JSON from {url}. Status: {response.status_code}. Content: {response.text[:200]}...", exc_info=True)
+                return {"error": "Ошибка чтения ответа от сервера.", "status_code": 500}
+        else:
+            return {"status": "ok"}
 
     except httpx.HTTPStatusError as e:
         error_detail = f"Ошибка API ({e.response.status_code})"
@@ -217,29 +381,41 @@ async def api_request(
     except Exception as e:
         logger.error(f"Unexpected Error during API request to {url}: {e}", exc_info=True) 
         return {"error": "Внутренняя ошибка бота при запросе к серверу.", "status_code": 500}
+    finally:
+        record_api_latency(metrics_key, (time.perf_counter() - started) * 1000, request_ok)
 # --- КОНЕЦ API REQUEST ---
 
 # --- НОВАЯ ФУНКЦИЯ: Проверка AI-Рубильника ---
+# Последний ответ и его ETag (BotTenant.ai_enabled_cache): если на сервере ничего не менялось, он ответит 304 без тела
 async def is_ai_enabled() -> bool:
     """
     Проверяет статус AI-Рубильника (ai_enabled) для текущей компании.
     """
-    global COMPANY_ID_FOR_BOT
+    _ai_enabled_cache = current_tenant().ai_enabled_cache
     
     # Запрашиваем только AI-Рубильник
     keys_to_fetch = ['ai_enabled'] 
+    headers = {'Content-Type': 'application/json'}
+    if _ai_enabled_cache["etag"]:
+        headers['If-None-Match'] = _ai_enabled_cache["etag"]
     
     # Используем публичный эндпоинт для бота
     api_settings = await api_request(
         "GET", 
         "/api/bot/settings", 
-        params={'company_id': COMPANY_ID_FOR_BOT, 'keys': keys_to_fetch}
+        params={'company_id': company_id_for_bot(), 'keys': keys_to_fetch},
+        headers=headers,
+        etag_store=_ai_enabled_cache
     )
     
+    if isinstance(api_settings, dict) and api_settings.get("status") == "not_modified":
+        return _ai_enabled_cache["value"]
+    
     if api_settings and "error" not in api_settings and isinstance(api_settings, list):
         settings_dict = {s.get('key'): s.get('value') for s in api_settings}
         # AI включен, если значение 'ai_enabled' равно строке 'True' или 'true'
-        return settings_dict.get('ai_enabled') in ['True', 'true']
+        _ai_enabled_cache["value"] = settings_dict.get('ai_enabled') in ['True', 'true']
+        return _ai_enabled_cache["value"]
     
     logger.error("Не удалось получить статус AI-Рубильника. Предполагаем, что AI отключен.")
     return False
@@ -255,14 +431,12 @@ async def notify_owner_of_complaint(context: ContextTypes.DEFAULT_TYPE, complain
 # --- КОНЕЦ ЗАГЛУШКИ ---
 
 # --- Функция идентификации бота (ОСТАЕТСЯ) ---
-def identify_bot_company() -> None:
+def identify_bot_company() -> BotTenant:
     """
-    Синхронная функция, вызываемая при запуске.
+    Синхронная функция, вызываемая при запуске отдельного бота (main).
     Обращается к API, чтобы узнать, к какой компании относится этот бот.
-    Устанавливает глобальные переменные COMPANY_ID_FOR_BOT и COMPANY_NAME_FOR_BOT.
+    (bot_host.py берет компании сразу из БД и эту функцию не вызывает.)
     """
-    global COMPANY_ID_FOR_BOT, COMPANY_NAME_FOR_BOT
-    
     print("[Startup] Идентификация компании бота через API...")
     payload = {"token": TELEGRAM_BOT_TOKEN}
     
@@ -273,13 +447,14 @@ def identify_bot_company() -> None:
             response.raise_for_status() 
             
             data = response.json()
-            COMPANY_ID_FOR_BOT = data.get("company_id")
-            COMPANY_NAME_FOR_BOT = data.get("company_name", "Ошибка имени")
+            company_id = data.get("company_id")
+            company_name = data.get("company_name", "Ошибка имени")
 
-            if not COMPANY_ID_FOR_BOT:
+            if not company_id:
                 raise Exception("API вернул пустой ID компании.")
                 
-            print(f"[Startup] УСПЕХ: Бот идентифицирован как '{COMPANY_NAME_FOR_BOT}' (ID: {COMPANY_ID_FOR_BOT})")
+            print(f"[Startup] УСПЕХ: Бот идентифицирован как '{company_name}' (ID: {company_id})")
+            return BotTenant(token=TELEGRAM_BOT_TOKEN, company_id=company_id, company_name=company_name)
 
     except httpx.HTTPStatusError as e:
         print("="*50)
@@ -346,7 +521,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     api_response = await api_request(
         "POST",
         "/api/bot/identify_user", 
-        json={"telegram_chat_id": chat_id, "company_id": COMPANY_ID_FOR_BOT} 
+        json={"telegram_chat_id": chat_id, "company_id": company_id_for_bot()} 
     )
 
     if api_response and "error" not in api_response:
@@ -408,7 +583,7 @@ async def handle_phone_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     api_response = await api_request(
         "POST",
         "/api/bot/identify_user", 
-        json={"telegram_chat_id": chat_id, "phone_number": normalized_phone, "company_id": COMPANY_ID_FOR_BOT}
+        json={"telegram_chat_id": chat_id, "phone_number": normalized_phone, "company_id": company_id_for_bot()}
     )
 
     if api_response and "error" not in api_response:
@@ -491,7 +666,7 @@ async def register_get_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
     payload = {
         "full_name": full_name,
         "phone": phone_to_register,
-        "company_id": COMPANY_ID_FOR_BOT,
+        "company_id": company_id_for_bot(),
         "telegram_chat_id": chat_id,
         "client_code_prefix": "TG" # Или логика префикса из прошлых шагов
     }
@@ -529,14 +704,14 @@ async def add_order_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
     # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
-    logger.info(f"Пользователь {client_id} начинает добавление заказа для компании {COMPANY_ID_FOR_BOT}.")
+    logger.info(f"Пользователь {client_id} начинает добавление заказа для компании {company_id_for_bot()}.")
 
     # --- Запрос к API ---
-    api_response = await api_request("GET", "/api/locations", params={'company_id': COMPANY_ID_FOR_BOT})
+    api_response = await api_request("GET", "/api/locations", params={'company_id': company_id_for_bot()})
 
     if not api_response or "error" in api_response or not isinstance(api_response, list) or not api_response:
         error_msg = api_response.get("error", "Филиалы не найдены.") if api_response else "Нет ответа."
-        logger.error(f"Ошибка загрузки филиалов для company_id={COMPANY_ID_FOR_BOT}: {error_msg}")
+        logger.error(f"Ошибка загрузки филиалов для company_id={company_id_for_bot()}: {error_msg}")
         await update.message.reply_text(f"Ошибка: {error_msg}")
         return ConversationHandler.END 
 
@@ -607,7 +782,6 @@ async def add_order_received_track_code(update: Update, context: ContextTypes.DE
     2. Если кодов > 1: отправляет массово.
     3. Если код == 1: работает по старой логике (магия -> запрос комментария).
     """
-    global COMPANY_ID_FOR_BOT
     text_input = update.message.text.strip()
     client_id = context.user_data.get('client_id')
     location_id = context.user_data.get('location_id')
@@ -665,7 +839,7 @@ async def add_order_received_track_code(update: Update, context: ContextTypes.DE
         payload = {
             "client_id": client_id,
             "location_id": location_id,
-            "company_id": COMPANY_ID_FOR_BOT,
+            "company_id": company_id_for_bot(),
             "items": items_list
         }
 
@@ -706,7 +880,7 @@ async def add_order_received_track_code(update: Update, context: ContextTypes.DE
         claim_payload = {
             "track_code": track_code,
             "client_id": client_id,
-            "company_id": COMPANY_ID_FOR_BOT
+            "company_id": company_id_for_bot()
         }
         api_response = await api_request(
             "POST",
@@ -732,7 +906,7 @@ async def add_order_received_track_code(update: Update, context: ContextTypes.DE
             search_response = await api_request(
                  "GET",
                  "/api/orders", # Используем общий эндпоинт поиска
-                 params={"q": track_code, "company_id": COMPANY_ID_FOR_BOT, "limit": 1}
+                 params={"q": track_code, "company_id": company_id_for_bot(), "limit": 1}
             )
 
             if search_response and isinstance(search_response, list) and len(search_response) > 0:
@@ -784,8 +958,6 @@ async def save_order_from_bot(update: Update, context: ContextTypes.DEFAULT_TYPE
     (ИСПРАВЛЕНО 16.11) Финальный шаг: сохраняет новый заказ в базе через API,
     вызывая СТАНДАРТНЫЙ эндпоинт /api/orders.
     """
-    global COMPANY_ID_FOR_BOT
-    
     client_id = context.user_data.get('client_id')
     track_code = context.user_data.get('track_code')
     location_id = context.user_data.get('location_id')
@@ -811,7 +983,7 @@ async def save_order_from_bot(update: Update, context: ContextTypes.DEFAULT_TYPE
     payload = {
         "track_code": track_code,
         "client_id": client_id,
-        "company_id": COMPANY_ID_FOR_BOT,
+        "company_id": company_id_for_bot(),
         "location_id": location_id,
         "comment": final_comment,
         "purchase_type": "Доставка", # Всегда доставка из бота
@@ -975,16 +1147,18 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
         return 
 
-    # 2. ИНДИКАТОР РЕАКЦИИ
-    await context.bot.send_chat_action(chat_id=chat_id, action="typing")
+    # 2. ИНДИКАТОР РЕАКЦИИ + 3. ПРОВЕРКА РУБИЛЬНИКА (AI Toggle) - параллельно
+    _, ai_enabled = await asyncio.gather(
+        context.bot.send_chat_action(chat_id=chat_id, action="typing"),
+        is_ai_enabled()
+    )
     
     if client_id:
         markup = owner_main_menu_markup if is_owner else client_main_menu_markup
     else:
         markup = ReplyKeyboardRemove()
 
-    # 3. ПРОВЕРКА РУБИЛЬНИКА (AI Toggle)
-    if not (await is_ai_enabled()):
+    if not ai_enabled:
         if not client_id:
              await update.message.reply_text("Здравствуйте! Для начала работы нажмите /register.", reply_markup=ReplyKeyboardRemove())
         else:
@@ -1041,7 +1215,7 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
             # 1. ДЕЛАЕМ ПРОВЕРКУ (Check Only)
             api_response = await api_request("POST", "/api/bot/order_request", json={
                 "client_id": client_id, 
-                "company_id": COMPANY_ID_FOR_BOT, 
+                "company_id": company_id_for_bot(), 
                 "request_text": text,
                 "check_only": True 
             })
@@ -1100,10 +1274,17 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if len(history) > 10: history = history[-10:] # Храним последние 10 сообщений
 
     # --- СЫВОРОТКА ПРАВДЫ (Сбор данных о компании) ---
+    # Один запрос /api/bot/ai_context вместо четырех (филиалы, правила, профиль, заказы).
+    # Пока он идет, уже крутится индикатор "печатает" (notify_progress).
+    wait_task = asyncio.create_task(notify_progress(context, chat_id))
+    ai_context = await api_request("GET", "/api/bot/ai_context", params={"company_id": company_id_for_bot(), "client_id": client_id})
+    if not isinstance(ai_context, dict) or "error" in ai_context:
+        ai_context = {}
+
     company_info_text = ""
     try:
         # 1. Филиалы
-        loc_data = await api_request("GET", "/api/bot/locations", params={"company_id": COMPANY_ID_FOR_BOT})
+        loc_data = ai_context.get("locations")
         if loc_data:
             company_info_text += "\n🏢 **НАШИ АДРЕСА:**\n"
             for loc in loc_data:
@@ -1117,11 +1298,8 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
              company_info_text += "Адреса филиалов пока не настроены.\n"
 
         # 2. Правила (Settings)
-        rule_keys = ['rule_buyout', 'rule_delivery', 'rule_general']
-        rules_response = await api_request("GET", "/api/bot/settings", params={'company_id': COMPANY_ID_FOR_BOT, 'keys': rule_keys})
-        
-        if rules_response and isinstance(rules_response, list):
-            rules_dict = {r['key']: r['value'] for r in rules_response}
+        rules_dict = ai_context.get("rules")
+        if rules_dict:
             
             if rules_dict.get('rule_buyout'): 
                 company_info_text += f"\n🛒 **ВЫКУП:**\n{rules_dict['rule_buyout']}\n"
@@ -1150,23 +1328,13 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
     orders_str = "..."
     try:
         # Профиль
-        c_data = await api_request("GET", f"/api/clients/{client_id}", params={"company_id": COMPANY_ID_FOR_BOT})
+        c_data = ai_context.get("client")
         if c_data:
-             code = f"{c_data.get('client_code_prefix','')}{c_data.get('client_code_num','')}"
+             code = f"{c_data.get('client_code_prefix') or ''}{c_data.get('client_code_num') or ''}"
              client_profile_str = f"ФИО: {c_data.get('full_name')}\nКод: {code}\nТел: {c_data.get('phone')}"
         
-        # Заказы (только активные статусы)
-        active_statuses = ["В обработке", "Ожидает выкупа", "Выкуплен", "На складе в Китае", "В пути", "На складе в КР", "Готов к выдаче"]
-        o_data = await api_request("GET", "/api/orders", params={
-            "client_id": client_id, 
-            "company_id": COMPANY_ID_FOR_BOT, 
-            "statuses": active_statuses, 
-            "limit": 50
-        })
-        if o_data and isinstance(o_data, list):
-             orders_str = f"Активных заказов: {len(o_data)}."
-        else:
-             orders_str = "Активных заказов: 0."
+        # Заказы (только активные статусы, считает сервер)
+        orders_str = f"Активных заказов: {ai_context.get('active_orders_count', 0)}."
     except: pass
 
     # Формируем системный промпт
@@ -1179,7 +1347,7 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
         # logger.info(f"Режим Клиента для {client_id}")
 
     # Формируем системный промпт
-    system_role = base_prompt.format(company_name=COMPANY_NAME_FOR_BOT)
+    system_role = base_prompt.format(company_name=company_name_for_bot())
     
     # Добавляем контекст (дату, профиль)
     system_role += (
@@ -1192,8 +1360,7 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
     )
     # ---------------------------------
 
-    # 6. ЗАПРОС ИИ
-    wait_task = asyncio.create_task(notify_progress(context, chat_id))
+    # 6. ЗАПРОС ИИ (wait_task уже запущен перед сбором контекста)
     
     try:
         # 1. Получаем ответ от ИИ
@@ -1329,7 +1496,7 @@ async def process_text_logic(update: Update, context: ContextTypes.DEFAULT_TYPE,
                     tool_result = await execute_ai_tool(
                         tool_command=command, 
                         api_request_func=api_request, 
-                        company_id=COMPANY_ID_FOR_BOT, 
+                        company_id=company_id_for_bot(), 
                         employee_id=employee_id, 
                         client_id=client_id
                     )
@@ -1556,7 +1723,7 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     markup = owner_main_menu_markup if is_owner else client_main_menu_markup
 
     logger.info(f"Запрос профиля для клиента {client_id}")
-    api_response_client = await api_request("GET", f"/api/clients/{client_id}", params={'company_id': COMPANY_ID_FOR_BOT})
+    api_response_client = await api_request("GET", f"/api/clients/{client_id}", params={'company_id': company_id_for_bot()})
 
     if not api_response_client or "error" in api_response_client:
         error_msg = api_response_client.get("error", "Не удалось загрузить профиль.") if api_response_client else "Нет ответа."
@@ -1577,7 +1744,7 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"Запрос ссылки ЛК для клиента {client_id}")
     
     # --- ИЗМЕНЕНИЕ: /generate_lk_link - это POST ---
-    api_response_link = await api_request("POST", f"/api/clients/{client_id}/generate_lk_link", params={'company_id': COMPANY_ID_FOR_BOT})
+    api_response_link = await api_request("POST", f"/api/clients/{client_id}/generate_lk_link", params={'company_id': company_id_for_bot()})
     lk_url = None
     if api_response_link and "error" not in api_response_link:
         lk_url = api_response_link.get("link")
@@ -1609,7 +1776,7 @@ async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     params = {
         'client_id': client_id,
         'statuses': active_statuses,
-        'company_id': COMPANY_ID_FOR_BOT,
+        'company_id': company_id_for_bot(),
         'limit': 50 # (Увеличим лимит для группировки)
     }
     api_response = await api_request("GET", "/api/orders", params=params)
@@ -1793,7 +1960,7 @@ async def bishkek_contacts(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     is_owner = context.user_data.get('is_owner', False)
     markup = owner_main_menu_markup if is_owner else client_main_menu_markup
 
-    logger.info(f"Запрос контактов (выбор филиала) для компании {COMPANY_ID_FOR_BOT}")
+    logger.info(f"Запрос контактов (выбор филиала) для компании {company_id_for_bot()}")
 
     try:
         # 1. Получаем список филиалов (Locations)
@@ -1879,7 +2046,7 @@ async def location_contact_callback(update: Update, context: ContextTypes.DEFAUL
 
     # 3. Запрашиваем данные ТОЛЬКО ЭТОГО филиала
     # Используем публичный эндпоинт, который принимает company_id
-    api_response = await api_request("GET", f"/api/locations/{location_id}", params={'company_id': COMPANY_ID_FOR_BOT})
+    api_response = await api_request("GET", f"/api/locations/{location_id}", params={'company_id': company_id_for_bot()})
 
     if not api_response or "error" in api_response or not api_response.get('id'):
         error_msg = api_response.get("error", "Филиал не найден.") if api_response else "Нет ответа"
@@ -1959,7 +2126,7 @@ async def location_contact_back_callback(update: Update, context: ContextTypes.D
 
         # 2. Получаем ОБЩИЕ контакты И ГРАФИК РАБОТЫ (Используем /api/bot/settings)
         keys_to_fetch = ['whatsapp_link', 'instagram_link', 'map_link', 'office_schedule'] # <-- ДОБАВЛЕНО
-        api_settings = await api_request("GET", "/api/bot/settings", params={'company_id': COMPANY_ID_FOR_BOT, 'keys': keys_to_fetch})
+        api_settings = await api_request("GET", "/api/bot/settings", params={'company_id': company_id_for_bot(), 'keys': keys_to_fetch})
         
         settings_dict = {}
         if api_settings and "error" not in api_settings and isinstance(api_settings, list):
@@ -2033,7 +2200,7 @@ async def handle_reaction_callback(update: Update, context: ContextTypes.DEFAULT
             "client_id": client_id,
             "broadcast_id": broadcast_id,
             "reaction_type": reaction_type,
-            "company_id": COMPANY_ID_FOR_BOT
+            "company_id": company_id_for_bot()
         }
         api_response = await api_request("POST", "/api/bot/react", json=payload)
 
@@ -2106,7 +2273,7 @@ async def handle_ai_confirmation(update: Update, context: ContextTypes.DEFAULT_T
     try:
         # --- 1. ЗАКАЗЫ ---
         if data == "ai_confirm_update_single":
-            await api_request("PATCH", f"/api/orders/{action_data['order_id']}", employee_id=employee_id, json={"status": action_data['new_status'], "company_id": COMPANY_ID_FOR_BOT})
+            await api_request("PATCH", f"/api/orders/{action_data['order_id']}", employee_id=employee_id, json={"status": action_data['new_status'], "company_id": company_id_for_bot()})
             await query.edit_message_text(f"✅ Статус изменен на '{action_data['new_status']}'.")
 
         elif data == "ai_confirm_delete_order":
@@ -2138,11 +2305,11 @@ async def handle_ai_confirmation(update: Update, context: ContextTypes.DEFAULT_T
         # --- 2. КЛИЕНТЫ ---
         elif data == "ai_confirm_change_client_code":
             # Используем PATCH
-            await api_request("PATCH", f"/api/clients/{action_data['client_id']}", employee_id=employee_id, json={"client_code_num": action_data['new_code'], "company_id": COMPANY_ID_FOR_BOT})
+            await api_request("PATCH", f"/api/clients/{action_data['client_id']}", employee_id=employee_id, json={"client_code_num": action_data['new_code'], "company_id": company_id_for_bot()})
             await query.edit_message_text(f"✅ Код клиента изменен на {action_data['new_code']}.")
 
         elif data == "ai_confirm_delete_client":
-             await api_request("DELETE", f"/api/clients/{action_data['client_id']}", employee_id=employee_id, params={"company_id": COMPANY_ID_FOR_BOT})
+             await api_request("DELETE", f"/api/clients/{action_data['client_id']}", employee_id=employee_id, params={"company_id": company_id_for_bot()})
              await query.edit_message_text(f"✅ Клиент {action_data['client_name']} удален.")
 
         # --- 3. ФИНАНСЫ (ОБНОВЛЕНО v2 - С ФИЛИАЛАМИ) ---
@@ -2165,7 +2332,7 @@ async def handle_ai_confirmation(update: Update, context: ContextTypes.DEFAULT_T
                         return
                 else:
                     # Стандартный поиск (для сотрудника или если филиал один)
-                    active_shift = await api_request("GET", "/api/shifts/active", employee_id=employee_id, params={"company_id": COMPANY_ID_FOR_BOT})
+                    active_shift = await api_request("GET", "/api/shifts/active", employee_id=employee_id, params={"company_id": company_id_for_bot()})
                     if active_shift and active_shift.get('id'):
                         shift_id = active_shift['id']
                     else:
@@ -2178,7 +2345,7 @@ async def handle_ai_confirmation(update: Update, context: ContextTypes.DEFAULT_T
                 "amount": action_data['amount'],
                 "notes": action_data['reason'],
                 "expense_type_id": action_data['expense_type_id'],
-                "company_id": COMPANY_ID_FOR_BOT,
+                "company_id": company_id_for_bot(),
                 "shift_id": shift_id 
             }
             
@@ -2200,7 +2367,7 @@ async def handle_ai_confirmation(update: Update, context: ContextTypes.DEFAULT_T
             payload = {
                 "text": text, 
                 "photo_file_id": photo, # Передаем ID фото
-                "company_id": COMPANY_ID_FOR_BOT
+                "company_id": company_id_for_bot()
             }
             
             resp = await api_request("POST", "/api/bot/broadcast", employee_id=employee_id, json=payload)
@@ -2210,7 +2377,7 @@ async def handle_ai_confirmation(update: Update, context: ContextTypes.DEFAULT_T
             context.user_data.pop('ai_broadcast_text', None)
             context.user_data.pop('ai_broadcast_photo', None)
             
-            await query.edit_message_text(f"✅ Рассылка успешно отправлена {count} клиентам.")
+            await query.edit_message_text(f"✅ Рассылка запущена: {count} получателей. Сообщения уходят постепенно.")
 
         # --- 5. МАССОВОЕ (ПО ID) ---
         elif data == "ai_confirm_bulk_status_manual":
@@ -2273,7 +2440,7 @@ async def handle_ai_confirmation(update: Update, context: ContextTypes.DEFAULT_T
             if payload_src.get('new_prefix'): api_payload['client_code_prefix'] = payload_src['new_prefix'] # <-- Новое
             
             # Добавляем company_id, так как API требует его для проверок уникальности
-            api_payload['company_id'] = COMPANY_ID_FOR_BOT
+            api_payload['company_id'] = company_id_for_bot()
 
             # Вызываем API обновления
             await api_request("PATCH", f"/api/clients/{client_id}", employee_id=employee_id, json=api_payload)
@@ -2439,7 +2606,7 @@ async def handle_owner_order_search(update: Update, context: ContextTypes.DEFAUL
         "GET", 
         "/api/orders",
         employee_id=employee_id, # <--- Аутентификация
-        params={'q': search_term, 'company_id': COMPANY_ID_FOR_BOT, 'limit': 1000}
+        params={'q': search_term, 'company_id': company_id_for_bot(), 'limit': 1000}
     )
 
     if not api_response or "error" in api_response or not isinstance(api_response, list):
@@ -2531,7 +2698,7 @@ async def handle_owner_client_search(update: Update, context: ContextTypes.DEFAU
         "GET", 
         "/api/clients/search", 
         employee_id=employee_id, 
-        params={'q': search_term, 'company_id': COMPANY_ID_FOR_BOT}
+        params={'q': search_term, 'company_id': company_id_for_bot()}
     )
     
     if not api_response or "error" in api_response or not isinstance(api_response, list):
@@ -2576,7 +2743,7 @@ async def owner_locations(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
          await update.message.reply_text("Ошибка аутентификации Владельца. Попробуйте /start", reply_markup=markup)
          return
 
-    api_response = await api_request("GET", "/api/locations", employee_id=employee_id, params={'company_id': COMPANY_ID_FOR_BOT})
+    api_response = await api_request("GET", "/api/locations", employee_id=employee_id, params={'company_id': company_id_for_bot()})
 
     if not api_response or "error" in api_response or not isinstance(api_response, list):
         error_msg = api_response.get("error", "Нет ответа") if api_response else "Нет ответа"
@@ -2807,7 +2974,7 @@ async def handle_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT
     payload = {
         'text': broadcast_text_html,
         'photo_file_id': photo_file_id, # <-- Добавляем ID фото (будет None, если фото нет)
-        'company_id': COMPANY_ID_FOR_BOT
+        'company_id': company_id_for_bot()
     }
 
     api_response = await api_request(
@@ -2826,8 +2993,8 @@ async def handle_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text(f"❌ Ошибка при запуске рассылки: {error_msg}")
     else:
         sent_count = api_response.get('sent_to_clients', 0)
-        logger.info(f"Рассылка Владельца (EID: {employee_id}) завершена. Отправлено: {sent_count}")
-        await update.message.reply_text(f"✅ Рассылка успешно отправлена {sent_count} клиентам.")
+        logger.info(f"Рассылка Владельца (EID: {employee_id}) запущена. Получателей: {sent_count}")
+        await update.message.reply_text(f"✅ Рассылка запущена: {sent_count} получателей. Сообщения уходят постепенно.")
         
     return ConversationHandler.END
 
@@ -3020,7 +3187,7 @@ async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     api_response = await api_request(
         "POST",
         "/api/bot/unlink",
-        json={"telegram_chat_id": chat_id, "company_id": COMPANY_ID_FOR_BOT}
+        json={"telegram_chat_id": chat_id, "company_id": company_id_for_bot()}
     )
 
     if not api_response or "error" in api_response:
@@ -3115,15 +3282,16 @@ async def handle_ai_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # --- 12. Запуск Бота ---
 
-def main() -> None:
-    """Главная функция запуска бота."""
-    
-    # --- Идентифицируем бота ПЕРЕД запуском ---
-    identify_bot_company()
-    # (Если ошибка, sys.exit(1) уже остановил программу)
-
-    logger.info(f"Запуск бота для компании '{COMPANY_NAME_FOR_BOT}' (ID: {COMPANY_ID_FOR_BOT})...")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(tenant: BotTenant, builder: Optional[ApplicationBuilder] = None) -> Application:
+    """
+    Создает Application бота компании со всеми обработчиками.
+    builder - для bot_host.py (общие HTTP-пулы); по умолчанию обычный builder с токеном компании.
+    """
+    if builder is None:
+        builder = Application.builder().token(tenant.token).post_shutdown(close_api_client)
+    application = builder.build()
+    application.bot_data["tenant"] = tenant
+    application.add_handler(TypeHandler(object, bind_tenant), group=-100)
 
     # --- Диалог Регистрации (Теперь по команде /register) ---
     registration_conv = ConversationHandler(
@@ -3265,7 +3433,7 @@ def main() -> None:
     # Обработчик фото И документов-картинок для AI-рассылок
     application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_ai_photo))
 
-    logger.info(f"Бот (ID: {COMPANY_ID_FOR_BOT}) запущен и готов к работе...")
+    logger.info(f"Бот (ID: {tenant.company_id}) запущен и готов к работе...")
     # --- Диалог Импорта Excel (Владелец) ---
     owner_import_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Document.FileExtension("xlsx"), owner_handle_document)],
@@ -3279,6 +3447,25 @@ def main() -> None:
         per_user=True, per_chat=True, name="owner_import"
     )
     application.add_handler(owner_import_conv)
+    return application
+
+
+def main() -> None:
+    """Главная функция запуска бота (один процесс = один бот; для многих ботов см. bot_host.py)."""
+    # Проверка, что все переменные окружения заданы
+    if not TELEGRAM_BOT_TOKEN or not ADMIN_API_URL: # <-- Убрали DATABASE_URL
+        logger.critical("="*50)
+        logger.critical("КРИТИЧЕСКАЯ ОШИБКА: bot_template.py")
+        logger.critical("Не найдены переменные окружения: TELEGRAM_BOT_TOKEN или ADMIN_API_URL.")
+        logger.critical("="*50)
+        sys.exit(1)
+
+    # --- Идентифицируем бота ПЕРЕД запуском ---
+    tenant = identify_bot_company()
+    # (Если ошибка, sys.exit(1) уже остановил программу)
+
+    logger.info(f"Запуск бота для компании '{tenant.company_name}' (ID: {tenant.company_id})...")
+    application = build_application(tenant)
     application.run_polling()
     
 # --- НОВАЯ ФУНКЦИЯ (ЗАГЛУШКА): Уведомление Владельца о Жалобе ---
@@ -3308,7 +3495,7 @@ async def handle_confirm_add_orders(update: Update, context: ContextTypes.DEFAUL
         # Реальное сохранение (check_only=False)
         api_response = await api_request("POST", "/api/bot/order_request", json={
             "client_id": client_id, 
-            "company_id": COMPANY_ID_FOR_BOT, 
+            "company_id": company_id_for_bot(), 
             "request_text": text,
             "check_only": False 
         })
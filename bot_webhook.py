@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# bot_webhook.py
+# Webhook-режим для ботов компаний: одно ASGI-приложение принимает апдейты ВСЕХ ботов.
+#
+# Зачем: в режиме polling (bot_template.py / bot_host.py) каждый бот держит long polling к Telegram,
+# даже когда ему никто не пишет. В webhook-режиме Telegram сам присылает апдейт:
+#   POST {BOT_WEBHOOK_BASE_URL}/tg/<route_key>   (route_key - хеш токена, см. bot_host.webhook_route_key)
+#   -> проверка X-Telegram-Bot-Api-Secret-Token -> очередь -> общий пул воркеров -> Application компании.
+# Ответ Telegram уходит сразу после постановки в очередь; если очередь переполнена - 503, и Telegram повторит позже.
+#
+# Порядок апдейтов: апдейты одного чата всегда попадают в одну очередь (шард по token + chat_id),
+# поэтому диалоги (ConversationHandler) не перемешиваются, а разные чаты и компании идут параллельно.
+#
+# Несколько экземпляров за одним балансировщиком: состояние диалогов хранится в памяти процесса,
+# поэтому балансировщик должен направлять один путь всегда на один экземпляр
+# (например, nginx: hash $request_uri consistent).
+#
+# Запуск:
+#   BOT_WEBHOOK_BASE_URL=https://bots.example.com/tg BOT_WEBHOOK_SECRET=... python bot_webhook.py --port 8443
+# Локальная проверка без Telegram: fake_telegram.py (setWebhook запоминается, POST /updates/<token> доставляется сюда).
+
+import os
+import argparse
+import asyncio
+import hmac
+import logging
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from fastapi import FastAPI, Header, Request, Response
+from telegram import Update
+
+import bot_template
+from bot_host import BotHost, HostedBot
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ ---
+BOT_WEBHOOK_BASE_URL = os.getenv("BOT_WEBHOOK_BASE_URL") # Публичный адрес до /tg (https)
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET") # Из него выводится secret_token каждого бота
+BOT_WEBHOOK_WORKERS = int(os.getenv("BOT_WEBHOOK_WORKERS", "32")) # Общий пул на все компании
+BOT_WEBHOOK_QUEUE_SIZE = int(os.getenv("BOT_WEBHOOK_QUEUE_SIZE", "200")) # На одного воркера
+BOT_WEBHOOK_DRAIN_SECONDS = 30 # При остановке даем дообработать очередь
+
+
+class UpdateDispatcher:
+    """Общий пул воркеров: очередь на воркер, апдейты одного чата - всегда в одну очередь."""
+
+    def __init__(self, workers: int = BOT_WEBHOOK_WORKERS, queue_size: int = BOT_WEBHOOK_QUEUE_SIZE):
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+
+    def submit(self, hosted: HostedBot, update: Update) -> bool:
+        """False - очередь переполнена (ответим Telegram 503, он повторит)."""
+        chat_key = update.effective_chat.id if update.effective_chat else (
+            update.effective_user.id if update.effective_user else update.update_id
+        )
+        queue = self.queues[hash((hosted.tenant.token, chat_key)) % len(self.queues)]
+        try:
+            queue.put_nowait((hosted, update))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            hosted, update = await queue.get()
+            try:
+                await hosted.application.process_update(update)
+            except Exception as e:
+                logger.error(f"[Webhook] Ошибка обработки апдейта {update.update_id} (компания {hosted.tenant.company_id}): {e}", exc_info=True)
+            finally:
+                queue.task_done()
+
+    async def stop(self) -> None:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout=BOT_WEBHOOK_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"[Webhook] Не дообработано апдейтов при остановке: {self.pending()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_webhook_app(host: BotHost, dispatcher: Optional[UpdateDispatcher] = None) -> FastAPI:
+    """ASGI-приложение приема апдейтов. Хост ботов и воркеры живут вместе с приложением (lifespan)."""
+    dispatcher = dispatcher or UpdateDispatcher()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        stop_event = asyncio.Event()
+        dispatcher.start()
+        host_task = asyncio.create_task(host.run(stop_event))
+        try:
+            yield
+        finally:
+            await dispatcher.stop() # Сначала дообрабатываем принятые апдейты, потом останавливаем ботов
+            stop_event.set()
+            await host_task
+
+    app = FastAPI(title="Cargo Bots Webhook", lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+    @app.post("/tg/{route_key}")
+    async def telegram_webhook(
+        route_key: str,
+        request: Request,
+        x_telegram_bot_api_secret_token: Optional[str] = Header(None)
+    ):
+        hosted = host.routes.get(route_key)
+        if hosted is None:
+            return Response(status_code=404)
+        if not hmac.compare_digest(x_telegram_bot_api_secret_token or "", hosted.webhook_secret):
+            return Response(status_code=403)
+        try:
+            update = Update.de_json(await request.json(), hosted.application.bot)
+        except Exception as e:
+            logger.warning(f"[Webhook] Некорректный апдейт для компании {hosted.tenant.company_id}: {e}")
+            return Response(status_code=400)
+        if not dispatcher.submit(hosted, update):
+            return Response(status_code=503)
+        return Response(status_code=200)
+
+    @app.get("/healthz")
+    def healthz():
+        return {"bots": len(host.bots), "failed": len(host.failed), "pending_updates": dispatcher.pending()}
+
+    @app.post("/refresh")
+    def refresh(x_webhook_secret: Optional[str] = Header(None)):
+        """Перечитать компании сразу (например, после добавления компании в админке)."""
+        if not hmac.compare_digest(x_webhook_secret or "", host.webhook_secret):
+            return Response(status_code=403)
+        host.refresh_event.set()
+        return {"status": "ok"}
+
+    return app
+
+
+def main_cli() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Webhook-прием апдейтов для ботов всех компаний")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    args = parser.parse_args()
+
+    if not bot_template.ADMIN_API_URL or not BOT_WEBHOOK_BASE_URL or not BOT_WEBHOOK_SECRET:
+        logger.critical("Нужны переменные окружения ADMIN_API_URL, BOT_WEBHOOK_BASE_URL и BOT_WEBHOOK_SECRET.")
+        raise SystemExit(1)
+    app = create_webhook_app(BotHost(webhook_url=BOT_WEBHOOK_BASE_URL, webhook_secret=BOT_WEBHOOK_SECRET))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main_cli()
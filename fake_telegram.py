@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# fake_telegram.py
+# Локальная заглушка Telegram Bot API для нагрузочных тестов (load_bench.py).
+#
+# Принимает запросы вида POST /bot<token>/<method> (как api.telegram.org), ничего никуда не шлет,
+# а отвечает как настоящий Bot API и считает сообщения по токенам.
+# Чтобы API/воркер слали сюда, запустите их с TG_API_BASE_URL=http://127.0.0.1:8081/bot
+#
+# Запуск:
+#   python fake_telegram.py --port 8081 --latency-ms 30 --flood-every 500
+#
+# Настройки (флаги или переменные окружения):
+#   FAKE_TG_LATENCY_MS  - задержка ответа (имитация сети до Telegram)
+#   FAKE_TG_FLOOD_EVERY - каждое N-е сообщение отвечает 429 (RetryAfter), 0 = никогда
+#   FAKE_TG_FAIL_EVERY  - каждое N-е сообщение отвечает 403 (бот заблокирован), 0 = никогда
+#
+# Входящие апдейты для тестов ботов (bot_host.py): POST /updates/<token> с телом Update (без update_id) -
+# бот получит его через getUpdates, а если бот вызвал setWebhook - заглушка сама отправит апдейт
+# на его webhook с заголовком X-Telegram-Bot-Api-Secret-Token (как Telegram; см. bot_webhook.py).
+# Что бот ответил: GET /sent/<token>.
+
+import argparse
+import asyncio
+import itertools
+import os
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+LATENCY_MS = float(os.getenv("FAKE_TG_LATENCY_MS", "30"))
+FLOOD_EVERY = int(os.getenv("FAKE_TG_FLOOD_EVERY", "0"))
+FAIL_EVERY = int(os.getenv("FAKE_TG_FAIL_EVERY", "0"))
+FLOOD_RETRY_AFTER = 1
+
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageCaption"}
+
+app = FastAPI(title="Fake Telegram Bot API")
+
+_message_ids = itertools.count(1)
+_update_ids = itertools.count(1)
+_pending_updates: Dict[str, asyncio.Queue] = defaultdict(asyncio.Queue) # token -> апдейты для getUpdates
+_sent: Dict[str, deque] = defaultdict(lambda: deque(maxlen=1000)) # token -> последние отправленные сообщения
+_webhooks: Dict[str, Dict[str, Any]] = {} # token -> {"url", "secret_token"}
+_webhook_client: Optional[httpx.AsyncClient] = None
+_stats: Dict[str, Any] = {"started_at": time.time(), "requests": Counter(), "delivered": Counter(),
+                          "flood_429": 0, "forbidden_403": 0, "first_at": None, "last_at": None}
+
+
+def _ok(result: Any) -> JSONResponse:
+    return JSONResponse({"ok": True, "result": result})
+
+
+def _message(token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    chat_id = payload.get("chat_id")
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        pass
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": int(token.split(":")[0]) if token.split(":")[0].isdigit() else 1, "is_bot": True, "first_name": "Fake Bot"},
+        "text": payload.get("text") or payload.get("caption") or "",
+    }
+
+
+async def _payload(request: Request) -> Dict[str, Any]:
+    """
+    Bot API принимает JSON и формы. python-telegram-bot шлет x-www-form-urlencoded
+    (multipart - только при загрузке файлов; тогда нужен python-multipart).
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return await request.json()
+    if content_type.startswith("multipart/"):
+        return dict(await request.form())
+    body = (await request.body()).decode("utf-8", errors="replace")
+    return {key: values[-1] for key, values in parse_qs(body).items()}
+
+
+@app.post("/bot{token}/{method}")
+async def bot_method(token: str, method: str, request: Request):
+    payload = await _payload(request)
+    _stats["requests"][method] += 1
+
+    if method == "getUpdates":
+        if token in _webhooks:
+            return JSONResponse(status_code=409, content={
+                "ok": False, "error_code": 409, "description": "Conflict: can't use getUpdates method while webhook is active"
+            })
+        return _ok(await _get_updates(token, payload))
+
+    if method == "setWebhook":
+        _webhooks[token] = {"url": payload.get("url"), "secret_token": payload.get("secret_token")}
+        return _ok(True)
+    if method == "deleteWebhook":
+        _webhooks.pop(token, None)
+        return _ok(True)
+    if method == "getWebhookInfo":
+        webhook = _webhooks.get(token, {})
+        return _ok({"url": webhook.get("url") or "", "has_custom_certificate": False, "pending_update_count": _pending_updates[token].qsize()})
+
+    if LATENCY_MS > 0:
+        await asyncio.sleep(LATENCY_MS / 1000)
+
+    if method == "getMe":
+        return _ok({"id": 1, "is_bot": True, "first_name": "Fake Bot", "username": "fake_bot"})
+
+    if method in SEND_METHODS:
+        number = sum(_stats["requests"][m] for m in SEND_METHODS)
+        if FLOOD_EVERY and number % FLOOD_EVERY == 0:
+            _stats["flood_429"] += 1
+            return JSONResponse(status_code=429, content={
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {FLOOD_RETRY_AFTER}",
+                "parameters": {"retry_after": FLOOD_RETRY_AFTER}
+            })
+        if FAIL_EVERY and number % FAIL_EVERY == 0:
+            _stats["forbidden_403"] += 1
+            return JSONResponse(status_code=403, content={
+                "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"
+            })
+        now = time.time()
+        _stats["first_at"] = _stats["first_at"] or now
+        _stats["last_at"] = now
+        _stats["delivered"][token] += 1
+        message = _message(token, payload)
+        _sent[token].append(message)
+        return _ok(message)
+
+    # Остальные методы (answerCallbackQuery, setWebhook, ...) просто подтверждаем
+    return _ok(True)
+
+
+async def _get_updates(token: str, payload: Dict[str, Any]) -> list:
+    """Long polling как у Telegram: ждем первый апдейт до timeout секунд, потом забираем все накопленные."""
+    queue = _pending_updates[token]
+    try:
+        timeout = float(payload.get("timeout") or 0)
+    except (TypeError, ValueError):
+        timeout = 0
+    updates = []
+    try:
+        updates.append(await asyncio.wait_for(queue.get(), timeout=max(timeout, 0.01)))
+    except asyncio.TimeoutError:
+        return []
+    while not queue.empty():
+        updates.append(queue.get_nowait())
+    return updates
+
+
+@app.post("/updates/{token}")
+async def push_update(token: str, request: Request):
+    """Кладет входящий апдейт (как будто пользователь написал боту)."""
+    update = await request.json()
+    update.setdefault("update_id", next(_update_ids))
+    webhook = _webhooks.get(token)
+    if webhook is None:
+        _pending_updates[token].put_nowait(update)
+        return {"status": "ok", "update_id": update["update_id"]}
+    return {"status": "ok", "update_id": update["update_id"], "webhook_status": await _deliver_webhook(webhook, update)}
+
+
+async def _deliver_webhook(webhook: Dict[str, Any], update: Dict[str, Any]) -> int:
+    """Отправляет апдейт на webhook бота; возвращает HTTP-статус (0 - webhook недоступен)."""
+    global _webhook_client
+    if _webhook_client is None:
+        _webhook_client = httpx.AsyncClient(timeout=10)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": webhook["secret_token"]} if webhook.get("secret_token") else {}
+    try:
+        response = await _webhook_client.post(webhook["url"], json=update, headers=headers)
+        return response.status_code
+    except httpx.HTTPError:
+        return 0
+
+
+@app.get("/sent/{token}")
+def get_sent(token: str):
+    return list(_sent[token])
+
+
+@app.get("/stats")
+def get_stats():
+    """Счетчики для load_bench.py: сколько сообщений принято, по токенам, и за какое время."""
+    first_at, last_at = _stats["first_at"], _stats["last_at"]
+    return {
+        "delivered_total": sum(_stats["delivered"].values()),
+        "delivered_by_token": dict(_stats["delivered"]),
+        "requests_by_method": dict(_stats["requests"]),
+        "flood_429": _stats["flood_429"],
+        "forbidden_403": _stats["forbidden_403"],
+        "delivery_window_seconds": (last_at - first_at) if first_at and last_at else 0,
+    }
+
+
+@app.post("/reset")
+def reset_stats():
+    _stats.update({"requests": Counter(), "delivered": Counter(), "flood_429": 0, "forbidden_403": 0,
+                   "first_at": None, "last_at": None})
+    _pending_updates.clear()
+    _sent.clear()
+    _webhooks.clear()
+    return {"status": "ok"}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_MS)
+    parser.add_argument("--flood-every", type=int, default=FLOOD_EVERY)
+    parser.add_argument("--fail-every", type=int, default=FAIL_EVERY)
+    args = parser.parse_args()
+    LATENCY_MS, FLOOD_EVERY, FAIL_EVERY = args.latency_ms, args.flood_every, args.fail_every
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# job_queue.py
+# Надежная очередь фоновых задач поверх Postgres (таблица background_jobs).
+#
+# Зачем: уведомления и рассылки раньше шли через FastAPI BackgroundTasks прямо в процессе API.
+# Перезапуск сервера терял их, а отправка конкурировала с обработкой запросов.
+# Теперь:
+#   - API только кладет задачу в таблицу (в той же транзакции, что и само изменение заказов);
+#   - отдельный процесс job_worker.py забирает задачи через FOR UPDATE SKIP LOCKED
+#     (несколько воркеров не возьмут одну задачу дважды);
+#   - при ошибке задача повторяется с растущей задержкой, после max_attempts -> 'failed';
+#   - "зависшие" задачи (воркер упал посреди работы) возвращаются в очередь, пока не кончатся попытки;
+#     пока задача выполняется, воркер обновляет locked_at, поэтому долгую задачу второй раз не запустят.
+#
+# Обработчики регистрируются декоратором @job_handler("тип") (см. main.py).
+
+import os
+import asyncio
+import logging
+import socket
+import traceback
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from models import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+# ID выполняемой задачи - для обработчика (например, журнал доставки помечает им отправленные сообщения,
+# и при повторе задачи уже доставленным получателям второй раз не отправляем)
+current_job_id: ContextVar[Optional[int]] = ContextVar("current_job_id", default=None)
+
+# --- НАСТРОЙКИ ---
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", "10"))
+JOB_STALE_AFTER_SECONDS = int(os.getenv("JOB_STALE_AFTER", "900")) # 15 минут без отметки воркера = воркер умер
+JOB_HEARTBEAT_SECONDS = max(JOB_STALE_AFTER_SECONDS / 3, 1) # Пока задача выполняется, воркер обновляет locked_at
+JOB_RETRY_BASE_SECONDS = 10
+
+# Приоритеты (чем больше, тем раньше берется)
+PRIORITY_LOW = -10
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 10
+
+JOB_QUEUE_INDEXES_SQL = [
+    # Частичный индекс только по ожидающим задачам: выборка следующей задачи не сканирует историю
+    "CREATE INDEX IF NOT EXISTS ix_background_jobs_pending ON background_jobs (priority DESC, run_at, id) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS ix_background_jobs_running ON background_jobs (locked_at) WHERE status = 'running'",
+]
+
+CLAIM_JOBS_SQL = text("""
+    UPDATE background_jobs AS j
+    SET status = 'running', locked_by = :worker_id, locked_at = now(), attempts = j.attempts + 1
+    WHERE j.id IN (
+        SELECT id FROM background_jobs
+        WHERE status = 'pending' AND run_at <= now()
+        ORDER BY priority DESC, run_at, id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING j.id, j.job_type, j.payload, j.attempts, j.max_attempts, j.company_id
+""")
+
+# Задача, которая роняет или вешает воркер, не должна возвращаться в очередь бесконечно:
+# attempts растет при каждом захвате, после max_attempts - 'failed'.
+RELEASE_STALE_JOBS_SQL = text("""
+    UPDATE background_jobs
+    SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+        finished_at = CASE WHEN attempts >= max_attempts THEN now() ELSE NULL END,
+        locked_by = NULL, locked_at = NULL,
+        last_error = CASE WHEN attempts >= max_attempts
+            THEN 'Воркер не завершил задачу (таймаут), попытки исчерпаны'
+            ELSE 'Воркер не завершил задачу (таймаут), возвращена в очередь' END
+    WHERE status = 'running' AND locked_at < now() - make_interval(secs => :stale_after)
+""")
+
+# Отметка "жив": долгая задача не считается зависшей и не запускается второй раз
+HEARTBEAT_JOB_SQL = text("""
+    UPDATE background_jobs SET locked_at = now()
+    WHERE id = :job_id AND status = 'running' AND locked_by = :worker_id
+""")
+
+FINISH_JOB_SQL = text("""
+    UPDATE background_jobs
+    SET status = 'done', finished_at = now(), locked_by = NULL, last_error = NULL
+    WHERE id = :job_id
+""")
+
+FAIL_JOB_SQL = text("""
+    UPDATE background_jobs
+    SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+        finished_at = CASE WHEN attempts >= max_attempts THEN now() ELSE NULL END,
+        run_at = now() + make_interval(secs => :retry_in),
+        locked_by = NULL,
+        last_error = :error
+    WHERE id = :job_id
+""")
+
+# --- РЕЕСТР ОБРАБОТЧИКОВ ---
+JobHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+JOB_HANDLERS: Dict[str, JobHandler] = {}
+
+
+def job_handler(job_type: str):
+    """Декоратор: регистрирует async-обработчик для типа задачи. Обработчик получает payload (dict)."""
+    def decorator(func: JobHandler) -> JobHandler:
+        JOB_HANDLERS[job_type] = func
+        return func
+    return decorator
+
+
+def enqueue_job(
+    db: Session,
+    job_type: str,
+    payload: Dict[str, Any],
+    company_id: Optional[int] = None,
+    priority: int = PRIORITY_NORMAL,
+    max_attempts: int = 5,
+    delay_seconds: float = 0,
+) -> BackgroundJob:
+    """
+    Кладет задачу в очередь. НЕ делает commit: задача сохранится вместе с остальными
+    изменениями вызывающего кода (или не сохранится вовсе, если будет rollback).
+    delay_seconds > 0 - выполнить не раньше чем через столько секунд (периодические задачи).
+    """
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f"Неизвестный тип фоновой задачи: {job_type}")
+    job = BackgroundJob(
+        company_id=company_id,
+        job_type=job_type,
+        payload=payload,
+        priority=priority,
+        max_attempts=max_attempts,
+    )
+    if delay_seconds > 0:
+        job.run_at = datetime.now(timezone.utc) + timedelta(seconds=delay_seconds)
+    db.add(job)
+    db.flush() # Нужен job.id для ответа API
+    return job
+
+
+def claim_jobs(db: Session, worker_id: str, limit: int = JOB_BATCH_SIZE) -> List[Any]:
+    """Забирает до limit готовых задач (помечает их 'running') и коммитит."""
+    db.execute(RELEASE_STALE_JOBS_SQL, {"stale_after": JOB_STALE_AFTER_SECONDS})
+    rows = db.execute(CLAIM_JOBS_SQL, {"worker_id": worker_id, "limit": limit}).fetchall()
+    db.commit()
+    return rows
+
+
+def finish_job(db: Session, job_id: int) -> None:
+    db.execute(FINISH_JOB_SQL, {"job_id": job_id})
+    db.commit()
+
+
+def fail_job(db: Session, job_id: int, attempts: int, error: str) -> None:
+    """Ошибка: повтор через 10, 20, 40... сек (или 'failed', если попытки кончились)."""
+    retry_in = JOB_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0))
+    db.execute(FAIL_JOB_SQL, {"job_id": job_id, "retry_in": retry_in, "error": error[:2000]})
+    db.commit()
+
+
+def heartbeat_job(db: Session, job_id: int, worker_id: str) -> None:
+    db.execute(HEARTBEAT_JOB_SQL, {"job_id": job_id, "worker_id": worker_id})
+    db.commit()
+
+
+async def _heartbeat(session_factory, job_id: int, worker_id: str) -> None:
+    """Каждые JOB_HEARTBEAT_SECONDS обновляет locked_at задачи, пока ее не отменят."""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        db = session_factory()
+        try:
+            await asyncio.to_thread(heartbeat_job, db, job_id, worker_id)
+        except Exception as e:
+            logger.warning(f"[Jobs] Не удалось обновить отметку задачи {job_id}: {e}")
+        finally:
+            db.close()
+
+
+def ensure_job_queue_indexes(db: Session) -> None:
+    for sql in JOB_QUEUE_INDEXES_SQL:
+        db.execute(text(sql))
+    db.commit()
+
+
+async def run_job(session_factory, row, worker_id: str) -> bool:
+    """Выполняет одну задачу и записывает результат. Возвращает True при успехе."""
+    handler = JOB_HANDLERS.get(row.job_type)
+    error = None
+    if handler is None:
+        error = f"Нет обработчика для типа '{row.job_type}'"
+    else:
+        heartbeat = asyncio.create_task(_heartbeat(session_factory, row.id, worker_id))
+        job_token = current_job_id.set(row.id)
+        try:
+            await handler(row.payload or {})
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+        finally:
+            current_job_id.reset(job_token)
+            heartbeat.cancel()
+
+    db = session_factory()
+    try:
+        if error is None:
+            await asyncio.to_thread(finish_job, db, row.id)
+            return True
+        logger.error(f"[Jobs] Задача {row.id} ({row.job_type}) попытка {row.attempts}/{row.max_attempts} не удалась: {error}")
+        await asyncio.to_thread(fail_job, db, row.id, row.attempts, error)
+        return False
+    finally:
+        db.close()
+
+
+async def run_worker(session_factory, worker_id: Optional[str] = None, stop_event: Optional[asyncio.Event] = None) -> None:
+    """
+    Основной цикл воркера: забрать пачку задач, выполнить параллельно, повторить.
+    Если задач нет - ждет JOB_POLL_INTERVAL_SECONDS.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    stop_event = stop_event or asyncio.Event()
+    logger.info(f"[Jobs] Воркер {worker_id} запущен.")
+
+    def _claim():
+        db = session_factory()
+        try:
+            return claim_jobs(db, worker_id)
+        finally:
+            db.close()
+
+    while not stop_event.is_set():
+        try:
+            rows = await asyncio.to_thread(_claim)
+        except Exception as e:
+            logger.error(f"[Jobs] Ошибка выборки задач: {e}")
+            rows = []
+
+        if rows:
+            await asyncio.gather(*(run_job(session_factory, row, worker_id) for row in rows))
+            continue
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    logger.info(f"[Jobs] Воркер {worker_id} остановлен.")
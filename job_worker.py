@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# job_worker.py
+# Отдельный процесс, выполняющий фоновые задачи из таблицы background_jobs
+# (уведомления клиентам, оповещения владельцам).
+#
+# Запуск (например, в supervisor рядом с API):
+#   [program:cargo_jobs]
+#   command=/home/baknur_user/cargo-crm/venv/bin/python job_worker.py
+#   directory=/home/baknur_user/cargo-crm
+#   autostart=true
+#   autorestart=true
+#
+# Воркеров можно запустить несколько: задачи разбираются через FOR UPDATE SKIP LOCKED.
+
+import asyncio
+import logging
+import signal
+
+# Импорт main регистрирует обработчики задач (@job_handler) и создает SessionLocal
+import main
+from job_queue import run_worker
+from async_db import dispose_async_engine
+from telegram_delivery import close_delivery_queues
+
+logger = logging.getLogger(__name__)
+
+
+async def _main():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError: # Windows
+            pass
+    try:
+        await run_worker(main.SessionLocal, stop_event=stop_event)
+    finally:
+        await close_delivery_queues() # HTTP-соединения ботов
+        await dispose_async_engine() # Пул asyncpg (уведомления и рассылки)
+
+
+if __name__ == "__main__":
+    logger.info("Запуск воркера фоновых задач...")
+    asyncio.run(_main())
@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# load_bench.py
+# Нагрузочный бенчмарк: несколько синтетических компаний + сценарии работы API под параллельной нагрузкой.
+#
+# Что делает:
+#   1. Генерирует N компаний (филиалы, клиенты, смены, заказы, история статусов, оплаты, расходы)
+#      по схеме models.py - см. seed_tenant в perf_check.py, здесь добавляются бот, история и открытые смены.
+#   2. Поднимает локально fake_telegram.py (заглушка Bot API) и API (uvicorn main:app) с воркером задач
+#      внутри процесса; уведомления и рассылки уходят в заглушку, а не в Telegram.
+#   3. Гоняет сценарии по HTTP с заданной параллельностью и печатает p50/p95/p99 и пропускную способность:
+#      список заказов в админке, массовая смена статуса, импорт, выдача, идентификация в боте,
+#      рассылка (время ответа API + скорость доставки до заглушки).
+#   4. Удаляет синтетические компании (если не передан --keep).
+#
+# ВНИМАНИЕ: пишет в базу из DATABASE_URL (.env). Только для локальной/тестовой базы:
+#   python load_bench.py --yes --companies 5 --orders 20000 --concurrency 16
+#   python load_bench.py --yes --scenarios orders_list,bot_identify --json bench.json
+# Уже запущенный API: --api-url http://127.0.0.1:8000 (он должен быть запущен с TG_API_BASE_URL на заглушку).
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time as time_module
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import text
+
+import main
+from main import SessionLocal, ensure_hot_filter_indexes, ensure_party_stats
+from perf_check import PerfTenant, cleanup_tenant, percentile, seed_tenant
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_PRICE_PER_KG_USD = 3.5
+BENCH_EXCHANGE_RATE_USD = 87.5
+BULK_STATUS_CHUNK = 50
+IMPORT_CHUNK = 200
+
+# --- ДОПОЛНИТЕЛЬНЫЕ ДАННЫЕ ДЛЯ БЕНЧМАРКА ---
+BENCH_BOT_CLIENTS_SQL = text("""
+    UPDATE clients SET telegram_chat_id = CAST(700000000 + id AS varchar)
+    WHERE company_id = :company_id AND id % :every = 0
+""")
+
+# История: у каждого заказа "В пути" + текущий статус (если он другой)
+BENCH_HISTORY_SQL = text("""
+    INSERT INTO order_history (order_id, status, created_at)
+    SELECT id, 'В пути', created_at FROM orders WHERE company_id = :company_id
+    UNION ALL
+    SELECT id, status, COALESCE(issued_at, created_at + interval '3 days')
+    FROM orders WHERE company_id = :company_id AND status <> 'В пути'
+""")
+
+# Выдача требует открытую смену в филиале заказа
+BENCH_OPEN_SHIFTS_SQL = text("""
+    INSERT INTO shifts (start_time, starting_cash, exchange_rate_usd, price_per_kg_usd, employee_id, company_id, location_id)
+    SELECT now(), 0, :exchange_rate, :price_per_kg, :employee_id, :company_id, loc
+    FROM unnest(CAST(:location_ids AS integer[])) loc
+""")
+
+# То, что создают сами сценарии (рассылки, журналы, операции), удаляем до общей очистки perf_check
+BENCH_CLEANUP_SQL = [
+    "DELETE FROM broadcast_reactions WHERE broadcast_id IN (SELECT id FROM broadcasts WHERE company_id = :company_id)",
+    "DELETE FROM broadcast_recipients WHERE broadcast_id IN (SELECT id FROM broadcasts WHERE company_id = :company_id)",
+    "DELETE FROM broadcasts WHERE company_id = :company_id",
+    "DELETE FROM telegram_deliveries WHERE company_id = :company_id",
+    "DELETE FROM notification_history WHERE company_id = :company_id",
+    "DELETE FROM bulk_operations WHERE company_id = :company_id",
+    "DELETE FROM background_jobs WHERE company_id = :company_id",
+    "DELETE FROM settings WHERE company_id = :company_id",
+]
+
+
+@dataclass
+class BenchTenant:
+    perf: PerfTenant
+    bot_token: str
+    clients: int
+    chat_ids: List[str] = field(default_factory=list)
+
+    @property
+    def company_id(self) -> int:
+        return self.perf.company_id
+
+
+@dataclass
+class BenchContext:
+    tenants: List[BenchTenant]
+    run_id: str
+    pools: Dict[str, List[Any]] = field(default_factory=dict)
+
+
+@dataclass
+class BenchRequest:
+    method: str
+    path: str
+    employee_id: Optional[int] = None
+    params: Optional[Dict[str, Any]] = None
+    json: Optional[Any] = None
+
+
+@dataclass
+class Scenario:
+    """Сценарий: prepare (синхронно, готовит пул работы из БД) и build (i-й запрос или None, если работа кончилась)."""
+    name: str
+    build: Callable[[BenchContext, int], Optional[BenchRequest]]
+    default_requests: int
+    prepare: Optional[Callable[[BenchContext], None]] = None
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    requests: int
+    ok: int
+    errors: Dict[str, int]
+    seconds: float
+    latencies_ms: List[float]
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    def summary(self) -> Dict[str, Any]:
+        lat = self.latencies_ms
+        return {
+            "scenario": self.name,
+            "requests": self.requests,
+            "ok": self.ok,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 2),
+            "throughput_rps": round(self.ok / self.seconds, 1) if self.seconds else 0,
+            "p50_ms": round(statistics.median(lat), 1) if lat else None,
+            "p95_ms": round(percentile(lat, 0.95), 1) if lat else None,
+            "p99_ms": round(percentile(lat, 0.99), 1) if lat else None,
+            **self.extra,
+        }
+
+
+# --- ГЕНЕРАЦИЯ ДАННЫХ ---
+
+def seed_bench_tenants(tenants: List[BenchTenant], companies: int, orders: int, clients: int, days: int,
+                       bot_share: float, run_id: str) -> List[BenchTenant]:
+    """
+    Создает компании бенчмарка и дописывает их в tenants (список вызывающего).
+    Компания попадает в список сразу после seed_tenant: если генерация упадет на середине,
+    вызывающий код удалит и уже созданные компании, и недонастроенную.
+    """
+    every = max(int(round(1 / bot_share)), 1) if bot_share > 0 else 10 ** 9
+    for n in range(1, companies + 1):
+        db = SessionLocal()
+        try:
+            print(f"Компания {n}/{companies}:")
+            perf = seed_tenant(db, orders, clients, days, name=f"BENCH {run_id} {n}")
+            bot_token = f"{900000000 + perf.company_id}:BENCH{run_id}"
+            tenant = BenchTenant(perf=perf, bot_token=bot_token, clients=clients)
+            tenants.append(tenant)
+            db.execute(text("UPDATE companies SET telegram_bot_token = :token WHERE id = :company_id"),
+                       {"token": bot_token, "company_id": perf.company_id})
+            db.execute(BENCH_BOT_CLIENTS_SQL, {"company_id": perf.company_id, "every": every})
+            history = db.execute(BENCH_HISTORY_SQL, {"company_id": perf.company_id}).rowcount
+            db.execute(BENCH_OPEN_SHIFTS_SQL, {
+                "company_id": perf.company_id, "location_ids": perf.location_ids, "employee_id": perf.owner_id,
+                "exchange_rate": BENCH_EXCHANGE_RATE_USD, "price_per_kg": BENCH_PRICE_PER_KG_USD
+            })
+            tenant.chat_ids = [r[0] for r in db.execute(
+                text("SELECT telegram_chat_id FROM clients WHERE company_id = :company_id AND telegram_chat_id IS NOT NULL"),
+                {"company_id": perf.company_id}
+            )]
+            db.commit()
+            db.execute(text("ANALYZE order_history"))
+            db.commit()
+            print(f"  история: {history} строк, клиентов с ботом: {len(tenant.chat_ids)}")
+        finally:
+            db.close()
+    return tenants
+
+
+def cleanup_bench_tenants(tenants: List[BenchTenant]) -> None:
+    db = SessionLocal()
+    try:
+        for tenant in tenants:
+            for sql in BENCH_CLEANUP_SQL:
+                db.execute(text(sql), {"company_id": tenant.company_id})
+            db.commit()
+            cleanup_tenant(db, tenant.perf)
+    finally:
+        db.close()
+
+
+# --- СЦЕНАРИИ ---
+
+def _tenant(ctx: BenchContext, i: int) -> BenchTenant:
+    return ctx.tenants[i % len(ctx.tenants)]
+
+
+def _pool_item(ctx: BenchContext, name: str, i: int):
+    pool = ctx.pools.get(name) or []
+    return pool[i] if i < len(pool) else None
+
+
+def _fetch_order_ids(company_id: int, statuses: List[str]) -> List[Tuple[int, int]]:
+    """(location_id, order_id) заказов компании в указанных статусах."""
+    db = SessionLocal()
+    try:
+        return [(r.location_id, r.id) for r in db.execute(
+            text("SELECT location_id, id FROM orders WHERE company_id = :company_id AND status = ANY(:statuses) ORDER BY id"),
+            {"company_id": company_id, "statuses": statuses}
+        )]
+    finally:
+        db.close()
+
+
+def prepare_bulk_status(ctx: BenchContext) -> None:
+    """Пачки по 50 заказов "В пути" -> "На складе в КР" (каждая пачка используется один раз), компании вперемешку."""
+    per_tenant = []
+    for tenant in ctx.tenants:
+        ids = [order_id for _, order_id in _fetch_order_ids(tenant.company_id, ["В пути"])]
+        per_tenant.append([(tenant, ids[k:k + BULK_STATUS_CHUNK]) for k in range(0, len(ids), BULK_STATUS_CHUNK)])
+    ctx.pools["bulk_status"] = [item for group in itertools.zip_longest(*per_tenant) for item in group if item]
+
+
+def build_bulk_status(ctx: BenchContext, i: int) -> Optional[BenchRequest]:
+    item = _pool_item(ctx, "bulk_status", i)
+    if item is None:
+        return None
+    tenant, order_ids = item
+    return BenchRequest("POST", "/api/orders/bulk_action", tenant.perf.owner_id, json={
+        "action": "update_status", "order_ids": order_ids, "new_status": "На складе в КР"
+    })
+
+
+def prepare_issue(ctx: BenchContext) -> None:
+    per_tenant = [[(tenant, order_id) for _, order_id in _fetch_order_ids(tenant.company_id, ["Готов к выдаче"])]
+                  for tenant in ctx.tenants]
+    ctx.pools["issue"] = [item for group in itertools.zip_longest(*per_tenant) for item in group if item]
+
+
+def build_issue(ctx: BenchContext, i: int) -> Optional[BenchRequest]:
+    item = _pool_item(ctx, "issue", i)
+    if item is None:
+        return None
+    tenant, order_id = item
+    return BenchRequest("POST", "/api/orders/issue", tenant.perf.owner_id, json={
+        "orders": [{"order_id": order_id, "weight_kg": 1.5}],
+        "price_per_kg_usd": BENCH_PRICE_PER_KG_USD,
+        "exchange_rate_usd": BENCH_EXCHANGE_RATE_USD,
+        "paid_cash": 0, "paid_card": 0 # Без оплаты: выдача в долг (проходит и через баланс клиента)
+    })
+
+
+def build_import(ctx: BenchContext, i: int) -> BenchRequest:
+    tenant = _tenant(ctx, i)
+    items = [{
+        "track_code": f"BENCH{ctx.run_id}-{i:06d}-{j:03d}",
+        "client_code": f"PF{(i * IMPORT_CHUNK + j) % tenant.clients + 1}",
+    } for j in range(IMPORT_CHUNK)]
+    return BenchRequest("POST", "/api/orders/bulk_import", tenant.perf.owner_id, json={
+        "orders_data": items, "location_id": tenant.perf.location_ids[0]
+    })
+
+
+def build_orders_list(ctx: BenchContext, i: int) -> BenchRequest:
+    tenant = _tenant(ctx, i)
+    # Владелец и сотрудник филиала по очереди: разные планы (все филиалы / свой филиал)
+    employee_id = tenant.perf.owner_id if i % 2 == 0 else tenant.perf.staff_id
+    return BenchRequest("GET", "/api/orders", employee_id, params={
+        "company_id": tenant.company_id, "limit": 50, "fields": "id,track_code,status,party_date,client"
+    })
+
+
+def build_bot_identify(ctx: BenchContext, i: int) -> Optional[BenchRequest]:
+    tenant = _tenant(ctx, i)
+    if not tenant.chat_ids:
+        return None
+    return BenchRequest("POST", "/api/bot/identify_user", json={
+        "company_id": tenant.company_id, "telegram_chat_id": tenant.chat_ids[(i // len(ctx.tenants)) % len(tenant.chat_ids)]
+    })
+
+
+SCENARIOS: Dict[str, Scenario] = {s.name: s for s in [
+    Scenario("orders_list", build_orders_list, default_requests=500),
+    Scenario("bulk_status", build_bulk_status, default_requests=100, prepare=prepare_bulk_status),
+    Scenario("import", build_import, default_requests=50),
+    Scenario("issue", build_issue, default_requests=300, prepare=prepare_issue),
+    Scenario("bot_identify", build_bot_identify, default_requests=1000),
+]}
+ALL_SCENARIOS = list(SCENARIOS) + ["broadcast"]
+
+
+# --- ЗАПУСК НАГРУЗКИ ---
+
+async def send_request(http: httpx.AsyncClient, request: BenchRequest) -> httpx.Response:
+    headers = {"X-Employee-ID": str(request.employee_id)} if request.employee_id else None
+    return await http.request(request.method, request.path, params=request.params, json=request.json, headers=headers)
+
+
+async def run_scenario(http: httpx.AsyncClient, ctx: BenchContext, scenario: Scenario, total: int, concurrency: int) -> ScenarioResult:
+    if scenario.prepare:
+        await asyncio.to_thread(scenario.prepare, ctx)
+    counter = itertools.count()
+    latencies: List[float] = []
+    errors: Counter = Counter()
+    sent = 0
+
+    async def worker():
+        nonlocal sent
+        while True:
+            i = next(counter)
+            if i >= total:
+                return
+            request = scenario.build(ctx, i)
+            if request is None: # Пул работы исчерпан (например, кончились заказы "Готов к выдаче")
+                return
+            sent += 1
+            started = time_module.perf_counter()
+            try:
+                response = await send_request(http, request)
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] += 1
+                continue
+            elapsed = (time_module.perf_counter() - started) * 1000
+            if response.status_code >= 400:
+                errors[f"HTTP {response.status_code}"] += 1
+            else:
+                latencies.append(elapsed)
+
+    started = time_module.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return ScenarioResult(scenario.name, sent, len(latencies), dict(errors), time_module.perf_counter() - started, latencies)
+
+
+async def run_broadcast(http: httpx.AsyncClient, tg: httpx.AsyncClient, ctx: BenchContext, timeout: float) -> ScenarioResult:
+    """
+    Рассылка от каждой компании одновременно. Латентность - ответ API (постановка в очередь),
+    а доставка (воркер -> заглушка Telegram) - отдельно: сколько сообщений и за сколько секунд дошло.
+    """
+    await tg.post("/reset")
+    expected = sum(len(t.chat_ids) for t in ctx.tenants)
+    latencies, errors, broadcasts = [], Counter(), []
+    started = time_module.perf_counter()
+
+    async def start(tenant: BenchTenant):
+        t0 = time_module.perf_counter()
+        response = await send_request(http, BenchRequest("POST", "/api/bot/broadcast", tenant.perf.owner_id, json={
+            "text": f"<b>Бенчмарк {ctx.run_id}</b>: тестовая рассылка"
+        }))
+        if response.status_code >= 400:
+            errors[f"HTTP {response.status_code}"] += 1
+            return
+        latencies.append((time_module.perf_counter() - t0) * 1000)
+        broadcasts.append((tenant, response.json().get("broadcast_id")))
+
+    await asyncio.gather(*(start(t) for t in ctx.tenants))
+
+    # Ждем, пока все рассылки закончатся (или таймаут)
+    deadline = time_module.perf_counter() + timeout
+    pending = list(broadcasts)
+    while pending and time_module.perf_counter() < deadline:
+        still = []
+        for tenant, broadcast_id in pending:
+            response = await send_request(http, BenchRequest("GET", f"/api/bot/broadcast/{broadcast_id}/progress", tenant.perf.owner_id))
+            if response.status_code != 200 or response.json().get("status") != "done":
+                still.append((tenant, broadcast_id))
+        pending = still
+        if pending:
+            await asyncio.sleep(0.5)
+    total_seconds = time_module.perf_counter() - started
+    if pending:
+        errors["timeout"] += len(pending)
+
+    stats = (await tg.get("/stats")).json()
+    window = stats.get("delivery_window_seconds") or 0
+    return ScenarioResult("broadcast", len(ctx.tenants), len(latencies), dict(errors), total_seconds, latencies, extra={
+        "messages_expected": expected,
+        "messages_delivered": stats.get("delivered_total", 0),
+        "delivery_msgs_per_sec": round(stats.get("delivered_total", 0) / window, 1) if window else None,
+        "flood_429": stats.get("flood_429", 0),
+    })
+
+
+# --- ЛОКАЛЬНЫЕ ПРОЦЕССЫ (API и заглушка Telegram) ---
+
+def start_process(args: List[str], env: Dict[str, str], log_path: Optional[str]) -> subprocess.Popen:
+    output = open(log_path, "ab") if log_path else subprocess.DEVNULL
+    return subprocess.Popen(args, cwd=REPO_DIR, env={**os.environ, **env}, stdout=output, stderr=subprocess.STDOUT)
+
+
+def wait_http(url: str, timeout: float = 60) -> None:
+    deadline = time_module.monotonic() + timeout
+    while time_module.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=2)
+            return
+        except httpx.HTTPError:
+            time_module.sleep(0.3)
+    raise RuntimeError(f"Сервис {url} не поднялся за {timeout} сек")
+
+
+def print_report(results: List[ScenarioResult]) -> None:
+    print(f"\n{'Сценарий':<14}{'запр.':>7}{'ok':>7}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  ошибки / доп.")
+    for result in results:
+        s = result.summary()
+        fmt = lambda v: "-" if v is None else f"{v}"
+        extra = {k: v for k, v in s.items() if k in result.extra}
+        print(f"{s['scenario']:<14}{s['requests']:>7}{s['ok']:>7}{s['throughput_rps']:>9}{fmt(s['p50_ms']):>9}"
+              f"{fmt(s['p95_ms']):>9}{fmt(s['p99_ms']):>9}  {s['errors'] or ''} {extra or ''}")
+
+
+async def run_all(args, ctx: BenchContext, scenarios: List[str]) -> List[ScenarioResult]:
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+    results = []
+    async with httpx.AsyncClient(base_url=args.api_url, timeout=120, limits=limits) as http, \
+            httpx.AsyncClient(base_url=args.fake_tg_url, timeout=30) as tg:
+        for name in scenarios:
+            print(f"Сценарий {name}...")
+            if name == "broadcast":
+                result = await run_broadcast(http, tg, ctx, args.broadcast_timeout)
+            else:
+                scenario = SCENARIOS[name]
+                total = args.requests or scenario.default_requests
+                result = await run_scenario(http, ctx, scenario, total, args.concurrency)
+            results.append(result)
+    return results
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк API на синтетических компаниях.")
+    parser.add_argument("--yes", action="store_true", help="Подтверждаю: база из DATABASE_URL тестовая, в нее можно писать")
+    parser.add_argument("--companies", type=int, default=5)
+    parser.add_argument("--orders", type=int, default=20000, help="Заказов на компанию")
+    parser.add_argument("--clients", type=int, default=2000, help="Клиентов на компанию")
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--bot-share", type=float, default=0.5, help="Доля клиентов, привязавших бота")
+    parser.add_argument("--scenarios", default=",".join(ALL_SCENARIOS), help=f"Через запятую: {','.join(ALL_SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=0, help="Запросов на сценарий (0 = по умолчанию для сценария)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--api-url", default=None, help="Уже запущенный API (иначе поднимается uvicorn)")
+    parser.add_argument("--api-port", type=int, default=18000)
+    parser.add_argument("--api-workers", type=int, default=1)
+    parser.add_argument("--fake-tg-url", default=None, help="Уже запущенный fake_telegram.py")
+    parser.add_argument("--fake-tg-port", type=int, default=18081)
+    parser.add_argument("--fake-tg-latency-ms", type=float, default=30)
+    parser.add_argument("--broadcast-timeout", type=float, default=300)
+    parser.add_argument("--log-dir", default=None, help="Куда писать вывод API и заглушки (по умолчанию отбрасывается)")
+    parser.add_argument("--json", default=None, help="Сохранить результаты в JSON-файл")
+    parser.add_argument("--keep", action="store_true", help="Не удалять синтетические компании")
+    args = parser.parse_args()
+
+    if not args.yes:
+        print("Бенчмарк создает в базе синтетические компании и нагружает API. Запустите с --yes на тестовой базе.")
+        return 2
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in ALL_SCENARIOS]
+    if unknown:
+        print(f"Неизвестные сценарии: {unknown}. Доступны: {ALL_SCENARIOS}")
+        return 2
+
+    run_id = datetime.now().strftime("%m%d%H%M%S")
+    log = lambda name: os.path.join(args.log_dir, f"{name}.log") if args.log_dir else None
+    processes: List[subprocess.Popen] = []
+    tenants: List[BenchTenant] = []
+    try:
+        main.Base.metadata.create_all(bind=main.engine)
+        ensure_party_stats()
+        ensure_hot_filter_indexes()
+        seed_bench_tenants(tenants, args.companies, args.orders, args.clients, args.days, args.bot_share, run_id)
+
+        if not args.fake_tg_url:
+            args.fake_tg_url = f"http://127.0.0.1:{args.fake_tg_port}"
+            processes.append(start_process(
+                [sys.executable, "fake_telegram.py", "--port", str(args.fake_tg_port), "--latency-ms", str(args.fake_tg_latency_ms)],
+                {}, log("fake_telegram")
+            ))
+            wait_http(f"{args.fake_tg_url}/stats")
+        if not args.api_url:
+            args.api_url = f"http://127.0.0.1:{args.api_port}"
+            processes.append(start_process(
+                [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.api_port),
+                 "--workers", str(args.api_workers), "--log-level", "warning"],
+                {"JOB_WORKER_IN_PROCESS": "1", "JOB_POLL_INTERVAL": "0.2", "TG_API_BASE_URL": f"{args.fake_tg_url}/bot"},
+                log("api")
+            ))
+            wait_http(f"{args.api_url}/docs")
+
+        results = asyncio.run(run_all(args, BenchContext(tenants=tenants, run_id=run_id), scenarios))
+        print_report(results)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({
+                    "run_id": run_id, "companies": args.companies, "orders_per_company": args.orders,
+                    "concurrency": args.concurrency, "results": [r.summary() for r in results]
+                }, f, ensure_ascii=False, indent=2)
+            print(f"\nРезультаты сохранены в {args.json}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if tenants and not args.keep:
+            cleanup_bench_tenants(tenants)
+            print("Синтетические компании удалены.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -20,6 +20,10 @@ BOT_SCRIPT_PATH = "/home/baknur_user/cargo-crm/bot_template.py" # Путь к т
 PYTHON_EXECUTABLE = "/home/baknur_user/cargo-crm/venv/bin/python" # Путь к Python в твоем venv
 USER = "baknur_user" # Имя пользователя Linux, от которого будут запускаться боты
 CONFIG_FILE_PREFIX = "cargo_bot_" # Префикс для файлов конфигурации
+# Режим --host: одна программа bot_host.py на все компании вместо процесса на компанию.
+# Компании она перечитывает из БД сама, поэтому manage_bots.py нужно запускать только при переходе.
+BOT_HOST_SCRIPT_PATH = "/home/baknur_user/cargo-crm/bot_host.py"
+HOST_PROGRAM_NAME = f"{CONFIG_FILE_PREFIX}host"
 
 # --- Шаблон конфигурационного файла Supervisor ---
 # %(program_name)s - имя программы (например, cargo_bot_WISH)
@@ -39,6 +43,20 @@ stdout_logfile=/var/log/supervisor/{program_name}_out.log
 environment=LANG="en_US.UTF-8",LC_ALL="en_US.UTF-8",ADMIN_API_URL="{api_url}",TELEGRAM_BOT_TOKEN="{bot_token}"{env_extras}
 """
 
+# Шаблон для bot_host.py (без токена: токены берутся из таблицы companies)
+HOST_CONFIG_TEMPLATE = """
+[program:{program_name}]
+command={python_executable} {bot_script_path}
+directory={project_dir}
+user={user}
+autostart=true
+autorestart=true
+stopwaitsecs=600 ; wait 10 minutes before killing the script
+stderr_logfile=/var/log/supervisor/{program_name}_err.log
+stdout_logfile=/var/log/supervisor/{program_name}_out.log
+environment=LANG="en_US.UTF-8",LC_ALL="en_US.UTF-8",ADMIN_API_URL="{api_url}"{env_extras}
+"""
+
 # --- Определение модели Company (только нужные поля) ---
 # Используем declarative_base(), чтобы не импортировать твои модели напрямую
 Base = declarative_base()
@@ -72,7 +90,10 @@ def run_supervisor_command(command):
 
 def main():
     """Основная функция скрипта."""
+    host_mode = "--host" in sys.argv[1:]
     logger.info("--- Запуск скрипта управления ботами Supervisor ---")
+    if host_mode:
+        logger.info(f"Режим --host: один процесс {HOST_PROGRAM_NAME} (bot_host.py) для всех компаний.")
 
     # --- Загрузка переменных окружения ---
     project_dir = os.path.dirname(os.path.abspath(__file__))
@@ -138,7 +159,10 @@ def main():
 
     # Словарь для отслеживания нужных конфигов {имя_программы: данные_компании}
     required_programs = {}
-    for company in companies_with_bots:
+    if host_mode:
+        # Отдельные cargo_bot_<КОД> станут лишними и будут удалены ниже
+        required_programs[HOST_PROGRAM_NAME] = None
+    for company in ([] if host_mode else companies_with_bots):
         if not company.company_code:
              logger.warning(f"Пропуск компании ID {company.id}: отсутствует company_code.")
              continue
@@ -170,21 +194,32 @@ def main():
         env_extras = f',GEMINI_API_KEY="{GEMINI_KEY}",DEEPSEEK_API_KEY="{DEEPSEEK_KEY}"'
         
         # (Оставим старую логику для ENABLE_AI, если она нужна)
-        if company.company_code == "TEST":
+        if company is not None and company.company_code == "TEST":
             env_extras += ',ENABLE_AI="True"'
         # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
 
-        conf_content = CONFIG_TEMPLATE.format(
-            program_name=program_name,
-            python_executable=PYTHON_EXECUTABLE,
-            bot_script_path=BOT_SCRIPT_PATH,
-            bot_token=company.telegram_bot_token,
-            company_id=company.id,
-            api_url=API_URL,
-            project_dir=project_dir,
-            user=USER,
-            env_extras=env_extras # <-- Вставляем доп. переменную
-        ).strip() + "\n" # Добавляем перенос строки в конце
+        if company is None: # Режим --host
+            conf_content = HOST_CONFIG_TEMPLATE.format(
+                program_name=program_name,
+                python_executable=PYTHON_EXECUTABLE,
+                bot_script_path=BOT_HOST_SCRIPT_PATH,
+                api_url=API_URL,
+                project_dir=project_dir,
+                user=USER,
+                env_extras=env_extras
+            ).strip() + "\n"
+        else:
+            conf_content = CONFIG_TEMPLATE.format(
+                program_name=program_name,
+                python_executable=PYTHON_EXECUTABLE,
+                bot_script_path=BOT_SCRIPT_PATH,
+                bot_token=company.telegram_bot_token,
+                company_id=company.id,
+                api_url=API_URL,
+                project_dir=project_dir,
+                user=USER,
+                env_extras=env_extras # <-- Вставляем доп. переменную
+            ).strip() + "\n" # Добавляем перенос строки в конце
 
         # Проверяем, существует ли файл и нужно ли его обновить
         needs_update = True
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# message_templates.py
+# Шаблоны уведомлений клиентам (смена статуса, массовая смена статуса, выкуп с трек-кодами).
+#
+# Зачем: тексты собирались большими ветками f-строк в трех местах main.py, и каждая рассылка
+# заново склеивала строки для каждого получателя. Здесь:
+#   - шаблон компилируется ОДИН раз (compile_template кэширует по тексту шаблона);
+#   - render_many отдает тексты сразу для тысяч получателей, общие для рассылки значения
+#     (статус и т.п.) передаются один раз в shared;
+#   - значения экранируются для parse_mode=HTML автоматически (имя клиента с "<" больше не ломает сообщение).
+#
+# Синтаксис (подмножество Mustache):
+#   {{name}}                 - значение с HTML-экранированием
+#   {{{name}}}               - значение как есть (только для доверенного HTML)
+#   {{#name}}...{{/name}}    - блок, если значение непустое; для списка - по разу на каждый элемент
+#   {{^name}}...{{/name}}    - блок, если значение пустое
+#   {{.}}                    - текущий элемент списка
+# Неизвестное имя дает пустую строку (опечатка в шаблоне компании не ломает рассылку).
+#
+# Шаблоны компании хранятся в notification_templates (вид + статус), здесь - шаблоны по умолчанию.
+
+import html
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+# --- ВИДЫ УВЕДОМЛЕНИЙ ---
+KIND_STATUS = "status" # Подробное уведомление о статусе (вес, сумма, филиал)
+KIND_BULK_STATUS = "bulk_status" # Короткое уведомление при массовой смене статуса
+KIND_TRACK_UPDATE = "track_update" # Выкуп: трек-коды получены (mass_update_tracks)
+TEMPLATE_KINDS = (KIND_STATUS, KIND_BULK_STATUS, KIND_TRACK_UPDATE)
+ANY_STATUS = "*" # Шаблон для статусов без своего шаблона
+
+_TAG_RE = re.compile(r"\{\{\{\s*([\w.]+)\s*\}\}\}|\{\{\s*([#^/]?)\s*([\w.]+)\s*\}\}")
+
+Renderer = Callable[[list, Callable[[str], None]], None]
+
+
+class TemplateError(ValueError):
+    """Ошибка в тексте шаблона (незакрытый или лишний блок)."""
+
+
+def _lookup(stack: list, name: str) -> Any:
+    if name == ".":
+        return stack[-1]
+    for frame in reversed(stack):
+        if isinstance(frame, Mapping) and name in frame:
+            return frame[name]
+    return None
+
+
+def _text_node(value: str) -> Renderer:
+    def render(stack, out):
+        out(value)
+    return render
+
+
+def _var_node(name: str, escape: bool) -> Renderer:
+    def render(stack, out):
+        value = _lookup(stack, name)
+        if value is None:
+            return
+        out(html.escape(str(value)) if escape else str(value))
+    return render
+
+
+def _section_node(name: str, inverted: bool, children: Tuple[Renderer, ...]) -> Renderer:
+    def render(stack, out):
+        value = _lookup(stack, name)
+        if inverted:
+            if not value:
+                for child in children:
+                    child(stack, out)
+            return
+        if not value:
+            return
+        items = value if isinstance(value, (list, tuple)) else (value,)
+        for item in items:
+            stack.append(item)
+            try:
+                for child in children:
+                    child(stack, out)
+            finally:
+                stack.pop()
+    return render
+
+
+class CompiledTemplate:
+    """Разобранный шаблон: дерево функций, которое только пишет куски текста (без повторного разбора)."""
+
+    __slots__ = ("source", "_nodes")
+
+    def __init__(self, source: str, nodes: Tuple[Renderer, ...]):
+        self.source = source
+        self._nodes = nodes
+
+    def render(self, context: Mapping[str, Any], shared: Optional[Mapping[str, Any]] = None) -> str:
+        parts: List[str] = []
+        stack = [shared, context] if shared else [context]
+        for node in self._nodes:
+            node(stack, parts.append)
+        return "".join(parts)
+
+    def render_many(self, contexts: Iterable[Mapping[str, Any]], shared: Optional[Mapping[str, Any]] = None) -> List[str]:
+        """Тексты для многих получателей; shared - значения, общие для всей рассылки."""
+        nodes = self._nodes
+        result = []
+        for context in contexts:
+            parts: List[str] = []
+            out = parts.append
+            stack = [shared, context] if shared else [context]
+            for node in nodes:
+                node(stack, out)
+            result.append("".join(parts))
+        return result
+
+
+@lru_cache(maxsize=1024)
+def compile_template(source: str) -> CompiledTemplate:
+    """Разбирает шаблон. Кэш по тексту: одинаковые шаблоны (в том числе у разных компаний) разбираются один раз."""
+    root: List[Renderer] = []
+    open_sections: List[Tuple[str, bool, List[Renderer]]] = [] # (имя, инвертирован, узлы снаружи блока)
+    current = root
+    position = 0
+    for match in _TAG_RE.finditer(source):
+        if match.start() > position:
+            current.append(_text_node(source[position:match.start()]))
+        position = match.end()
+        raw_name, sigil, name = match.groups()
+        if raw_name:
+            current.append(_var_node(raw_name, escape=False))
+        elif sigil in ("#", "^"):
+            open_sections.append((name, sigil == "^", current))
+            current = []
+        elif sigil == "/":
+            if not open_sections or open_sections[-1][0] != name:
+                raise TemplateError(f"Лишний или неверный конец блока {{{{/{name}}}}}")
+            section_name, inverted, outer = open_sections.pop()
+            outer.append(_section_node(section_name, inverted, tuple(current)))
+            current = outer
+        else:
+            current.append(_var_node(name, escape=True))
+    if open_sections:
+        raise TemplateError(f"Блок {{{{#{open_sections[-1][0]}}}}} не закрыт")
+    if position < len(source):
+        current.append(_text_node(source[position:]))
+    return CompiledTemplate(source, tuple(root))
+
+
+# --- ШАБЛОНЫ ПО УМОЛЧАНИЮ ---
+# Ключ: (вид, статус). Тексты совпадают с прежними f-строками main.py.
+_GREETING = "Здравствуйте, <b>{{full_name}}</b>! 👋\n\n"
+_TRACKS = "{{#track_codes}}<code>{{.}}</code>\n{{/track_codes}}" # Каждый трек с новой строки
+
+DEFAULT_TEMPLATES: Dict[Tuple[str, str], str] = {
+    (KIND_STATUS, "Готов к выдаче"): (
+        _GREETING +
+        "🎉🎉🎉 <b>ПОСЫЛКИ НА МЕСТЕ!</b> 🎉🎉🎉\n\n"
+        "Спешим сообщить, что ваши заказы уже прибыли в наш филиал <b>'{{location_name}}'</b> и очень ждут вас!\n\n"
+        "<b>Трек-коды:</b>\n" + _TRACKS + "\n"
+        "<b>Статус:</b> ✅ <b>{{new_status}}</b> ✅\n"
+        "{{#total_weight}}Общий вес: <b>{{total_weight}} кг</b> ⚖️\n\n{{/total_weight}}"
+        "{{#total_cost}}К оплате: <b>{{total_cost}} сом</b> 💰\n\n{{/total_cost}}"
+        "📍 <b>Забрать можно здесь:</b>\n{{location_address}}\n\n"
+        "📞 <b>Вопросы? Звоните:</b> <code>{{location_phone}}</code>\n"
+        "💻 <b>Ваш Личный кабинет:</b> <a href='{{lk_link}}'>Перейти</a>"
+    ),
+    (KIND_STATUS, "В пути"): (
+        _GREETING +
+        "Ваши заказы уже мчатся к вам! 🚚💨\n\n"
+        "<b>Статус отправлений:</b>\n" + _TRACKS + "\n"
+        "...изменился на: ➡️ <b>{{new_status}}</b>\n"
+        "Мы сообщим, как только они прибудут! 🥳\nСледить за заказами можно в <a href='{{lk_link}}'>личном кабинете</a>."
+    ),
+    (KIND_STATUS, "На складе в КР"): (
+        _GREETING +
+        "Отличные новости! 🤩 Ваши заказы прибыли на наш склад в Кыргызстане!\n\n"
+        "<b>Статус посылок:</b>\n" + _TRACKS + "\n"
+        "...изменился на: 🇰🇬 <b>{{new_status}}</b> 🇰🇬\n"
+        "Сейчас мы их сортируем и скоро они будут готовы к выдаче! 🚀\n"
+        "Подробности в <a href='{{lk_link}}'>личном кабинете</a>."
+    ),
+    (KIND_STATUS, "Выдан"): (
+        _GREETING +
+        "🎉 <b>Посылки получены!</b> 🎉\n\n"
+        "Спасибо, что выбираете нас! Мы были рады видеть вас и вручить ваши заказы. 🤝\n\n"
+        "<b>Выданные трек-коды:</b>\n" + _TRACKS + "\n"
+        "Ждем вас снова за новыми покупками! 🚀\n"
+        "💻 <b>Ваш Личный кабинет:</b> <a href='{{lk_link}}'>Перейти</a>"
+    ),
+    (KIND_STATUS, ANY_STATUS): (
+        _GREETING +
+        "Обновление по вашим заказам! 📄\n\n"
+        "<b>Новый статус для:</b>\n" + _TRACKS + "\n"
+        "➡️ <b>{{new_status}}</b>\n"
+        "Подробности в <a href='{{lk_link}}'>личном кабинете</a>."
+    ),
+
+    (KIND_BULK_STATUS, "Готов к выдаче"): (
+        _GREETING +
+        "🎉 <b>Ваши заказы прибыли!</b> 🎉\n\n<b>Трек-коды:</b>\n" + _TRACKS + "\n"
+        "Статус: ✅ <b>{{new_status}}</b>\n\nПодробнее в <a href='{{lk_link}}'>личном кабинете</a>."
+    ),
+    (KIND_BULK_STATUS, "В пути"): (
+        _GREETING +
+        "Ваши заказы в пути! 🚚\n\n<b>Треки:</b>\n" + _TRACKS + "\n"
+        "Статус: ➡️ <b>{{new_status}}</b>\n\nСледите в <a href='{{lk_link}}'>личном кабинете</a>."
+    ),
+    (KIND_BULK_STATUS, ANY_STATUS): (
+        _GREETING +
+        "Обновление статуса! 📄\n\n<b>Треки:</b>\n" + _TRACKS + "\n"
+        "Новый статус: <b>{{new_status}}</b>"
+    ),
+
+    (KIND_TRACK_UPDATE, ANY_STATUS): (
+        "🎉 <b>Ура! Ваши товары выкуплены!</b>\n"
+        "Статусы обновлены, трек-коды получены.\n\n"
+        "{{#groups}}"
+        "📉 <b>Категория: Комиссия {{commission}}%</b>\n"
+        "📦 Список треков:\n"
+        "{{#orders}}<code>{{track_code}}</code>{{#comment}} ({{comment}}){{/comment}}\n{{/orders}}"
+        "🧾 <b>Расчет (Комиссия {{commission}}%):</b>\n"
+        "💴 Сумма товаров: <b>{{sum_cny}} ¥</b>\n"
+        "🔄 Курс пересчета: <b>{{rate}} с.</b>\n"
+        "Сумма товаров: <b>{{sum_som}} с.</b>\n\n"
+        "{{/groups}}"
+        "════════════════\n"
+        "🏁 <b>общий ИТОГ: {{grand_total}} с.</b>\n"
+        "{{#debt}}🔴 <b>Ваш текущий долг: -{{debt}} с.</b>\n{{/debt}}"
+        "{{^debt}}🟢 <b>Долгов нет (Оплачено).</b>\n{{/debt}}"
+        "ℹ️ <i>Вес и стоимость доставки будут посчитаны по прибытию.</i>"
+    ),
+}
+
+
+def template_source(kind: str, status: str, overrides: Optional[Mapping[Tuple[str, str], str]] = None) -> str:
+    """
+    Текст шаблона для (вид, статус). Порядок: шаблон компании для статуса -> шаблон компании для '*'
+    -> шаблон по умолчанию для статуса -> по умолчанию для '*'.
+    """
+    overrides = overrides or {}
+    return (
+        overrides.get((kind, status))
+        or overrides.get((kind, ANY_STATUS))
+        or DEFAULT_TEMPLATES.get((kind, status))
+        or DEFAULT_TEMPLATES[(kind, ANY_STATUS)]
+    )
+
+
+def get_template(kind: str, status: str, overrides: Optional[Mapping[Tuple[str, str], str]] = None) -> CompiledTemplate:
+    return compile_template(template_source(kind, status, overrides))
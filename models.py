@@ -1,6 +1,6 @@
 # models.py (ИСПРАВЛЕННАЯ ВЕРСИЯ ДЛЯ SUPER-ADMIN)
 
-from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, func, Date, Boolean, Table, UniqueConstraint
+from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, func, Date, Boolean, Table, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -457,3 +457,173 @@ class Transaction(Base):
     details = Column(JSON, nullable=True) # Хранит список треков и цен
 
     client = relationship("Client", back_populates="transactions")
+
+# --- НОВАЯ МОДЕЛЬ: ТЕКУЩИЙ БАЛАНС КЛИЕНТА ---
+class ClientBalance(Base):
+    """
+    Материализованный баланс клиента = SUM(transactions.amount).
+    Обновляется в той же транзакции, что и запись в transactions (apply_client_balance_delta в main.py),
+    периодически сверяется с журналом (задача reconcile_client_balances).
+    """
+    __tablename__ = 'client_balances'
+
+    client_id = Column(Integer, ForeignKey('clients.id', ondelete='CASCADE'), primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), nullable=False)
+    balance = Column(Float, nullable=False, default=0, server_default='0')
+    last_transaction_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Список должников = диапазон по индексу (company_id, balance < порог)
+        Index('ix_client_balances_company_balance', 'company_id', 'balance'),
+    )
+
+# --- НОВЫЕ МОДЕЛИ: ДНЕВНЫЕ ФИНАНСОВЫЕ ИТОГИ (для сводных отчетов) ---
+class DailyFinanceRollup(Base):
+    """
+    Приход за день по филиалу: оплаты при выдаче заказов и погашения долгов.
+    location_id = 0 - без филиала (оплата долга не в кассу смены).
+    Обновляется в тех же транзакциях, что и выдача/возврат/оплата (см. bump_daily_finance в main.py).
+    """
+    __tablename__ = 'daily_finance_rollups'
+
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), primary_key=True)
+    location_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+
+    orders_cash = Column(Float, nullable=False, default=0, server_default='0')
+    orders_card = Column(Float, nullable=False, default=0, server_default='0')
+    issued_count = Column(Integer, nullable=False, default=0, server_default='0')
+    debt_cash = Column(Float, nullable=False, default=0, server_default='0')
+    debt_card = Column(Float, nullable=False, default=0, server_default='0')
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class DailyExpenseRollup(Base):
+    """
+    Расходы за день по филиалу (филиал смены расхода; 0 = общие расходы) и типу расхода (0 = без типа).
+    Возвраты не выделяются отдельно: они определяются по имени типа при чтении отчета.
+    """
+    __tablename__ = 'daily_expense_rollups'
+
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), primary_key=True)
+    location_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    expense_type_id = Column(Integer, primary_key=True)
+
+    amount = Column(Float, nullable=False, default=0, server_default='0')
+    expense_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# --- НОВАЯ МОДЕЛЬ: СТАТИСТИКА ПАРТИЙ ---
+class PartyStats(Base):
+    """
+    Счетчики партии (company_id, party_date) в разрезе статусов: число заказов, вес, сумма.
+    Ведется триггером на orders (см. PARTY_STATS_FUNCTION_SQL в main.py), поэтому учитывает
+    любые изменения заказов: импорт, смену статусов, выдачу, удаление, перенос в другую партию.
+    """
+    __tablename__ = 'party_stats'
+
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), primary_key=True)
+    party_date = Column(Date, primary_key=True)
+    status = Column(String, primary_key=True)
+
+    order_count = Column(Integer, nullable=False, default=0, server_default='0')
+    total_weight_kg = Column(Float, nullable=False, default=0, server_default='0')
+    total_cost_som = Column(Float, nullable=False, default=0, server_default='0')
+
+# --- НОВАЯ МОДЕЛЬ: ЖУРНАЛ ДОСТАВКИ TELEGRAM-СООБЩЕНИЙ ---
+class TelegramDelivery(Base):
+    """
+    Результат отправки одного сообщения через очередь доставки (telegram_delivery.py).
+    Пишется пачками по ходу рассылки: видно, кому не дошло и почему (бот заблокирован, флуд-контроль и т.д.).
+    """
+    __tablename__ = 'telegram_deliveries'
+
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False, index=True)
+    client_id = Column(Integer, ForeignKey('clients.id', ondelete='SET NULL'), nullable=True, index=True)
+    chat_id = Column(String, nullable=False)
+
+    kind = Column(String, nullable=False) # 'status', 'bulk_status', 'owner', 'broadcast', 'message', 'track_update'
+    status = Column(String, nullable=False) # 'sent' или 'failed'
+    attempts = Column(Integer, nullable=False, default=1)
+    error = Column(String, nullable=True)
+    telegram_message_id = Column(Integer, nullable=True)
+    # Задача очереди, которая отправила сообщение: при повторе задачи уже доставленным не отправляем
+    job_id = Column(Integer, ForeignKey('background_jobs.id', ondelete='SET NULL'), nullable=True, index=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+# --- НОВАЯ МОДЕЛЬ: ШАБЛОНЫ УВЕДОМЛЕНИЙ КОМПАНИИ ---
+class NotificationTemplate(Base):
+    """
+    Свой текст уведомления компании для пары (вид уведомления, статус).
+    Нет строки - используется шаблон по умолчанию (message_templates.DEFAULT_TEMPLATES).
+    """
+    __tablename__ = 'notification_templates'
+    __table_args__ = (
+        UniqueConstraint('company_id', 'kind', 'status', name='_notification_template_uc'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = Column(String, nullable=False) # 'status', 'bulk_status', 'track_update'
+    status = Column(String, nullable=False) # Статус заказа или '*' (все статусы без своего шаблона)
+    body = Column(String, nullable=False) # Текст в синтаксисе message_templates.py
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# --- НОВАЯ МОДЕЛЬ: ОЧЕРЕДЬ ФОНОВЫХ ЗАДАЧ ---
+class BackgroundJob(Base):
+    """
+    Фоновая задача (уведомления, рассылки), которую выполняет отдельный процесс job_worker.py.
+    Задачи берутся через SELECT ... FOR UPDATE SKIP LOCKED, поэтому воркеров может быть несколько.
+    """
+    __tablename__ = 'background_jobs'
+
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), nullable=True, index=True)
+
+    job_type = Column(String, nullable=False) # 'notify_owners', 'bulk_status_notify', 'client_status_notify'
+    payload = Column(JSON, nullable=False)
+
+    # 'pending' -> 'running' -> 'done' / 'failed' (после max_attempts неудачных попыток)
+    status = Column(String, nullable=False, default='pending', server_default='pending')
+    priority = Column(Integer, nullable=False, default=0, server_default='0') # Чем больше, тем раньше
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    max_attempts = Column(Integer, nullable=False, default=5, server_default='5')
+    last_error = Column(String, nullable=True)
+
+    run_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now()) # Не раньше этого времени (для повторов)
+    locked_by = Column(String, nullable=True) # Имя воркера
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+# --- НОВАЯ МОДЕЛЬ: ПОЛУЧАТЕЛИ РАССЫЛКИ ---
+class BroadcastRecipient(Base):
+    """
+    Одна строка на получателя рассылки. По этим строкам воркер отправляет рассылку порциями
+    и продолжает с места остановки после перезапуска; из них же считается прогресс.
+    """
+    __tablename__ = 'broadcast_recipients'
+    __table_args__ = (
+        UniqueConstraint('broadcast_id', 'client_id', name='_broadcast_recipient_uc'),
+        # Выборка следующей порции: только еще не отправленные строки
+        Index('ix_broadcast_recipients_pending', 'broadcast_id', 'id', postgresql_where=text("status = 'pending'")),
+    )
+
+    id = Column(Integer, primary_key=True)
+    broadcast_id = Column(Integer, ForeignKey('broadcasts.id', ondelete='CASCADE'), nullable=False, index=True)
+    client_id = Column(Integer, ForeignKey('clients.id', ondelete='SET NULL'), nullable=True)
+    chat_id = Column(String, nullable=False)
+
+    status = Column(String, nullable=False, default='pending', server_default='pending') # 'pending', 'sending', 'sent', 'failed'
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    error = Column(String, nullable=True)
+    telegram_message_id = Column(Integer, nullable=True)
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+    claimed_at = Column(DateTime(timezone=True), nullable=True) # Когда строку взял воркер ('sending'); по нему находим брошенные порции
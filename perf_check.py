@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# perf_check.py
+# Проверка планов запросов и задержек "горячих" эндпоинтов на синтетической компании.
+#
+# Что делает:
+#   1. Создает компанию "PERF ..." с филиалами, клиентами, сменами, заказами, оплатами,
+#      расходами и журналом (generate_series, без загрузки строк в Python) и делает ANALYZE.
+#   2. Для каждого горячего запроса снимает EXPLAIN и проверяет, что используется
+#      ожидаемый индекс (см. HOT_FILTER_INDEXES_SQL в main.py) и нет Seq Scan по большим таблицам.
+#   3. Вызывает сам эндпоинт (TestClient, без сети) несколько раз и сравнивает p95 с бюджетом.
+#   4. Удаляет синтетическую компанию (если не передан --keep).
+#
+# ВНИМАНИЕ: пишет в базу из DATABASE_URL (.env). Запускать на тестовой/staging базе:
+#   python perf_check.py --yes --orders 200000 --clients 5000
+# Код выхода 1, если хоть одна проверка не прошла (удобно для CI).
+
+import argparse
+import json
+import statistics
+import sys
+import time as time_module
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import main
+from main import (
+    ALL_PERMISSIONS, ORDER_STATUSES, SHIFT_REPORTS_SQL, SessionLocal,
+    build_orders_query, ensure_hot_filter_indexes, ensure_party_stats
+)
+from models import (
+    AuditLog, Company, Employee, Expense, Location, Order, PartyStats, Permission, Role
+)
+
+ACTIVE_STATUSES = [s for s in ORDER_STATUSES if s != "Выдан"]
+STAFF_PERMISSIONS = ["view_orders", "view_shift_report", "issue_orders"]
+EXPENSE_TYPE_NAMES = ["Возврат товара", "Зарплата", "Хоз. нужды"]
+
+# --- SQL НАПОЛНЕНИЯ (все строки генерирует Postgres) ---
+SEED_CLIENTS_SQL = text("""
+    INSERT INTO clients (full_name, phone, client_code_prefix, client_code_num, status, company_id)
+    SELECT 'Клиент ' || g, '996' || lpad(g::text, 9, '0'), 'PF', g, 'Розница', :company_id
+    FROM generate_series(1, :n) g
+""")
+
+SEED_SHIFTS_SQL = text("""
+    INSERT INTO shifts (start_time, end_time, starting_cash, closing_cash, exchange_rate_usd, price_per_kg_usd,
+                        employee_id, company_id, location_id)
+    SELECT d + interval '9 hours', d + interval '19 hours', 1000, 1000, 87.5, 3.5,
+           :employee_id, :company_id, loc
+    FROM generate_series(CAST(CURRENT_DATE - CAST(:days AS integer) AS timestamptz), CURRENT_DATE, interval '1 day') d,
+         unnest(CAST(:location_ids AS integer[])) loc
+""")
+
+# ~70% заказов выданы (как в живой базе: выданные копятся годами), остальные размазаны по активным статусам.
+# Выданный заказ привязан к случайной смене своего филиала в пределах периода.
+SEED_ORDERS_SQL = text("""
+    WITH c AS (SELECT array_agg(id ORDER BY id) AS ids FROM clients WHERE company_id = :company_id),
+         s AS (SELECT location_id, array_agg(id ORDER BY id) AS ids FROM shifts WHERE company_id = :company_id GROUP BY location_id),
+         g AS (
+             SELECT g, (CAST(:location_ids AS integer[]))[1 + g % cardinality(CAST(:location_ids AS integer[]))] AS location_id,
+                    (g % 10) < 7 AS issued
+             FROM generate_series(1, :n) g
+         )
+    INSERT INTO orders (track_code, status, purchase_type, party_date, weight_kg, final_cost_som,
+                        calculated_final_cost_som, paid_cash_som, paid_card_som, issued_at,
+                        client_id, shift_id, company_id, location_id)
+    SELECT 'PERF' || lpad(g.g::text, 9, '0'),
+           CASE WHEN g.issued THEN 'Выдан'
+                ELSE (CAST(:active_statuses AS varchar[]))[1 + g.g % cardinality(CAST(:active_statuses AS varchar[]))] END,
+           'Доставка',
+           CURRENT_DATE - (g.g % CAST(:days AS integer)),
+           1 + (g.g % 50) / 10.0,
+           CASE WHEN g.issued THEN 300 + g.g % 700 END,
+           300 + g.g % 700,
+           CASE WHEN g.issued AND g.g % 3 <> 0 THEN 300 + g.g % 700 END,
+           CASE WHEN g.issued AND g.g % 3 = 0 THEN 300 + g.g % 700 END,
+           CASE WHEN g.issued THEN now() - make_interval(mins => CAST(CAST(g.g AS bigint) * CAST(:days AS integer) * 1440 / :n AS integer)) END,
+           c.ids[1 + g.g % cardinality(c.ids)],
+           CASE WHEN g.issued THEN s.ids[1 + g.g % cardinality(s.ids)] END,
+           :company_id, g.location_id
+    FROM g CROSS JOIN c JOIN s ON s.location_id = g.location_id
+""")
+
+SEED_PAYMENTS_SQL = text("""
+    INSERT INTO transactions (client_id, amount, transaction_type, description, payment_method, shift_id, created_at)
+    SELECT client_id, final_cost_som, 'payment', 'Оплата долга (perf)',
+           CASE WHEN id % 2 = 0 THEN 'cash' ELSE 'card' END, shift_id, issued_at
+    FROM orders
+    WHERE company_id = :company_id AND status = 'Выдан' AND id % 20 = 0
+""")
+
+SEED_EXPENSES_SQL = text("""
+    INSERT INTO expenses (amount, notes, created_at, shift_id, expense_type_id, company_id)
+    SELECT 100 + (s.id * k) % 900, 'perf', s.start_time + make_interval(hours => k),
+           s.id, t.ids[1 + (s.id + k) % cardinality(t.ids)], :company_id
+    FROM shifts s
+    CROSS JOIN generate_series(1, 3) k
+    CROSS JOIN (SELECT array_agg(id ORDER BY id) AS ids FROM expense_types WHERE company_id = :company_id) t
+    WHERE s.company_id = :company_id
+""")
+
+SEED_AUDIT_SQL = text("""
+    INSERT INTO audit_logs (company_id, event_type, entity_id, description, who_did_it, created_at)
+    SELECT :company_id, 'delete_order', 'PERF' || g, 'Заказ PERF' || g || ' удален', 'Perf Owner',
+           now() - make_interval(mins => CAST(CAST(g AS bigint) * CAST(:days AS integer) * 1440 / :n AS integer))
+    FROM generate_series(1, :n) g
+""")
+
+# Порядок удаления учитывает внешние ключи (party_stats, client_balances, дневные итоги удаляются каскадом)
+CLEANUP_SQL = [
+    "DELETE FROM transactions WHERE client_id IN (SELECT id FROM clients WHERE company_id = :company_id)",
+    "DELETE FROM expenses WHERE company_id = :company_id",
+    "DELETE FROM order_history WHERE order_id IN (SELECT id FROM orders WHERE company_id = :company_id)",
+    "DELETE FROM orders WHERE company_id = :company_id",
+    "DELETE FROM audit_logs WHERE company_id = :company_id",
+    "DELETE FROM shifts WHERE company_id = :company_id",
+    "DELETE FROM clients WHERE company_id = :company_id",
+    "DELETE FROM employees WHERE company_id = :company_id",
+    "DELETE FROM role_permissions WHERE role_id IN (SELECT id FROM roles WHERE company_id = :company_id)",
+    "DELETE FROM roles WHERE company_id = :company_id",
+    "DELETE FROM expense_types WHERE company_id = :company_id",
+    "DELETE FROM locations WHERE company_id = :company_id",
+    "DELETE FROM companies WHERE id = :company_id",
+]
+
+
+@dataclass
+class PerfTenant:
+    company_id: int
+    location_ids: List[int]
+    owner_id: int
+    staff_id: int
+    days: int
+
+
+@dataclass
+class HotCase:
+    """Один горячий запрос: как снять его план и как вызвать эндпоинт."""
+    name: str
+    statement: Callable[[Session, PerfTenant], Any]                       # SQLAlchemy-выражение для EXPLAIN
+    expected_indexes: Tuple[str, ...]                                    # Хотя бы один должен быть в плане (пусто - не проверяем)
+    request: Callable[[PerfTenant], Tuple[str, Dict[str, Any], int]]      # (путь, параметры, ID сотрудника)
+    budget_ms: float
+    no_seq_scan_on: Tuple[str, ...] = ("orders",)
+
+
+# --- НАПОЛНЕНИЕ ---
+
+def seed_tenant(db: Session, orders: int, clients: int, days: int, name: Optional[str] = None) -> PerfTenant:
+    """Создает синтетическую компанию. name должен быть уникальным (по умолчанию "PERF <время>")."""
+    stamp = name or f"PERF {datetime.now().strftime('%Y%m%d%H%M%S')}"
+    existing_permissions = {p.codename for p in db.query(Permission).all()}
+    for codename, description in ALL_PERMISSIONS.items():
+        if codename not in existing_permissions:
+            db.add(Permission(codename=codename, description=description))
+    db.flush()
+
+    company = Company(name=stamp, company_code=stamp.replace(" ", ""), is_active=True)
+    db.add(company)
+    db.flush()
+    locations = [Location(name=f"Perf филиал {i}", address="perf", company_id=company.id) for i in range(1, 4)]
+    db.add_all(locations)
+
+    owner_permissions = db.query(Permission).filter(Permission.codename.notin_(['manage_companies', 'impersonate_company'])).all()
+    owner_role = Role(name="Владелец", company_id=company.id, permissions=owner_permissions)
+    staff_role = Role(name="Сотрудник", company_id=company.id,
+                      permissions=db.query(Permission).filter(Permission.codename.in_(STAFF_PERMISSIONS)).all())
+    db.add_all([owner_role, staff_role])
+    db.flush()
+
+    owner = Employee(full_name="Perf Owner", password="perf", is_active=True, role_id=owner_role.id,
+                     company_id=company.id, location_id=locations[0].id)
+    staff = Employee(full_name="Perf Staff", password="perf", is_active=True, role_id=staff_role.id,
+                     company_id=company.id, location_id=locations[0].id)
+    db.add_all([owner, staff])
+    db.flush()
+
+    for name in EXPENSE_TYPE_NAMES:
+        db.execute(text("INSERT INTO expense_types (name, company_id) VALUES (:name, :company_id)"),
+                   {"name": name, "company_id": company.id})
+
+    location_ids = [loc.id for loc in locations]
+    params = {"company_id": company.id, "location_ids": location_ids, "days": days,
+              "employee_id": owner.id, "active_statuses": ACTIVE_STATUSES}
+    steps = [
+        ("клиенты", SEED_CLIENTS_SQL, {"n": clients}),
+        ("смены", SEED_SHIFTS_SQL, {}),
+        ("заказы", SEED_ORDERS_SQL, {"n": orders}),
+        ("оплаты", SEED_PAYMENTS_SQL, {}),
+        ("расходы", SEED_EXPENSES_SQL, {}),
+        ("журнал", SEED_AUDIT_SQL, {"n": max(orders // 10, 1)}),
+    ]
+    for title, sql, extra in steps:
+        started = time_module.monotonic()
+        result = db.execute(sql, {**params, **extra})
+        print(f"  {title}: {result.rowcount} строк за {time_module.monotonic() - started:.1f} сек")
+    db.commit()
+
+    for table in ("clients", "shifts", "orders", "transactions", "expenses", "audit_logs", "party_stats"):
+        db.execute(text(f"ANALYZE {table}"))
+    db.commit()
+    return PerfTenant(company.id, location_ids, owner.id, staff.id, days)
+
+
+def cleanup_tenant(db: Session, tenant: PerfTenant) -> None:
+    for sql in CLEANUP_SQL:
+        db.execute(text(sql), {"company_id": tenant.company_id})
+    db.commit()
+
+
+# --- EXPLAIN ---
+
+def explain(db: Session, statement) -> Dict[str, Any]:
+    """EXPLAIN (FORMAT JSON) для ORM-запроса или text(): компилируем в SQL драйвера и выполняем курсором."""
+    compiled = statement.compile(dialect=db.bind.dialect, compile_kwargs={"render_postcompile": True})
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def plan_nodes(plan: Dict[str, Any]):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def check_plan(plan: Dict[str, Any], case: HotCase) -> List[str]:
+    nodes = list(plan_nodes(plan))
+    used_indexes = {n["Index Name"] for n in nodes if n.get("Index Name")}
+    problems = []
+    if case.expected_indexes and not used_indexes & set(case.expected_indexes):
+        problems.append(f"нет ни одного из индексов {case.expected_indexes} (использованы: {sorted(used_indexes) or '-'})")
+    for n in nodes:
+        if n["Node Type"] == "Seq Scan" and n.get("Relation Name") in case.no_seq_scan_on:
+            problems.append(f"Seq Scan по {n['Relation Name']}")
+    return problems
+
+
+# --- ГОРЯЧИЕ ЗАПРОСЫ ---
+
+def _period(tenant: PerfTenant, days: int) -> Tuple[date, date]:
+    today = date.today()
+    return today - timedelta(days=days), today
+
+
+def _period_bounds(tenant: PerfTenant, days: int) -> Tuple[datetime, datetime]:
+    start, end = _period(tenant, days)
+    return datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.max.time())
+
+
+def _recent_shift_ids(db: Session, tenant: PerfTenant, days: int) -> List[int]:
+    start, _ = _period_bounds(tenant, days)
+    return [r.id for r in db.execute(
+        text("SELECT id FROM shifts WHERE company_id = :company_id AND start_time >= :start"),
+        {"company_id": tenant.company_id, "start": start}
+    )]
+
+
+HOT_CASES: List[HotCase] = [
+    HotCase(
+        name="orders: Владелец, все филиалы, по умолчанию",
+        statement=lambda db, t: build_orders_query(db, t.company_id, None, None, None, None, None, None, str(t.owner_id)).limit(50).statement,
+        expected_indexes=("ix_orders_company_party_id", "ix_orders_active_location_party"),
+        request=lambda t: ("/api/orders", {"company_id": t.company_id, "limit": 50, "fields": "id,track_code,status,party_date"}, t.owner_id),
+        budget_ms=150,
+    ),
+    HotCase(
+        name="orders: филиал + статус",
+        statement=lambda db, t: build_orders_query(db, t.company_id, None, None, None, None, ["В пути"], t.location_ids[0], str(t.owner_id)).limit(50).statement,
+        expected_indexes=("ix_orders_company_location_status_party",),
+        request=lambda t: ("/api/orders", {"company_id": t.company_id, "limit": 50, "statuses": "В пути", "location_id": t.location_ids[0], "fields": "id,track_code,status,party_date"}, t.owner_id),
+        budget_ms=150,
+    ),
+    HotCase(
+        name="orders: сотрудник филиала, по умолчанию",
+        statement=lambda db, t: build_orders_query(db, t.company_id, None, None, None, None, None, None, str(t.staff_id)).limit(50).statement,
+        expected_indexes=("ix_orders_active_location_party", "ix_orders_company_location_status_party"),
+        request=lambda t: ("/api/orders", {"company_id": t.company_id, "limit": 50, "fields": "id,track_code,status,party_date"}, t.staff_id),
+        budget_ms=150,
+    ),
+    HotCase(
+        name="reports/shifts: смены за 7 дней",
+        statement=lambda db, t: SHIFT_REPORTS_SQL.bindparams(shift_ids=_recent_shift_ids(db, t, 7)),
+        expected_indexes=("ix_orders_shift_status",),
+        request=lambda t: ("/api/reports/shifts", dict(zip(("start_date", "end_date"), _period(t, 7))), t.owner_id),
+        budget_ms=300,
+        no_seq_scan_on=("orders", "transactions", "expenses"),
+    ),
+    HotCase(
+        name="orders/issued: выданные за сутки",
+        statement=lambda db, t: db.query(Order).filter(
+            Order.company_id == t.company_id, Order.status == "Выдан",
+            Order.issued_at >= _period_bounds(t, 1)[0], Order.issued_at <= _period_bounds(t, 1)[1]
+        ).statement,
+        expected_indexes=("ix_orders_company_issued_at",),
+        request=lambda t: ("/api/orders/issued", dict(zip(("start_date", "end_date"), _period(t, 1))), t.owner_id),
+        budget_ms=1000, # Отдает полные заказы с клиентом: время уходит в сериализацию, а не в запрос
+    ),
+    HotCase(
+        name="expenses: расходы за 7 дней",
+        statement=lambda db, t: db.query(Expense).filter(
+            Expense.company_id == t.company_id,
+            Expense.created_at >= _period_bounds(t, 7)[0], Expense.created_at <= _period_bounds(t, 7)[1]
+        ).statement,
+        expected_indexes=("ix_expenses_company_created",),
+        request=lambda t: ("/api/expenses", dict(zip(("start_date", "end_date"), _period(t, 7))), t.owner_id),
+        budget_ms=300,
+        no_seq_scan_on=("expenses",),
+    ),
+    HotCase(
+        name="audit/search: журнал за 7 дней",
+        statement=lambda db, t: db.query(AuditLog).filter(
+            AuditLog.company_id == t.company_id,
+            AuditLog.created_at >= _period_bounds(t, 7)[0], AuditLog.created_at <= _period_bounds(t, 7)[1]
+        ).order_by(AuditLog.created_at.desc()).limit(50).statement,
+        expected_indexes=("ix_audit_logs_company_created",),
+        request=lambda t: ("/api/audit/search", dict(zip(("start_date", "end_date"), _period(t, 7))), t.owner_id),
+        budget_ms=500,
+        no_seq_scan_on=("audit_logs",),
+    ),
+    HotCase(
+        name="orders/parties: список партий",
+        statement=lambda db, t: db.query(PartyStats).filter(PartyStats.company_id == t.company_id, PartyStats.order_count > 0).statement,
+        expected_indexes=(), # party_stats маленькая, Seq Scan по ней нормален; главное - не трогать orders
+        request=lambda t: ("/api/orders/parties", {}, t.owner_id),
+        budget_ms=100,
+    ),
+]
+
+
+# --- ЗАМЕР ЗАДЕРЖЕК ---
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def measure(client, case: HotCase, tenant: PerfTenant, repeat: int) -> Tuple[List[float], Optional[str]]:
+    path, params, employee_id = case.request(tenant)
+    headers = {"X-Employee-ID": str(employee_id)}
+    timings = []
+    for i in range(repeat + 2): # 2 прогревочных вызова не считаем
+        started = time_module.perf_counter()
+        response = client.get(path, params=params, headers=headers)
+        elapsed = (time_module.perf_counter() - started) * 1000
+        if response.status_code != 200:
+            return timings, f"HTTP {response.status_code}: {response.text[:200]}"
+        if i >= 2:
+            timings.append(elapsed)
+    return timings, None
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Проверка планов и задержек горячих запросов на синтетической компании.")
+    parser.add_argument("--yes", action="store_true", help="Подтверждаю: база из DATABASE_URL тестовая, в нее можно писать")
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=180, help="Глубина истории (партии, смены, журнал)")
+    parser.add_argument("--repeat", type=int, default=20, help="Сколько раз вызывать каждый эндпоинт")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="Множитель бюджетов задержки (медленное железо)")
+    parser.add_argument("--keep", action="store_true", help="Не удалять синтетическую компанию после проверки")
+    parser.add_argument("--skip-latency", action="store_true", help="Только EXPLAIN, без вызова эндпоинтов")
+    args = parser.parse_args()
+
+    if not args.yes:
+        print("Скрипт создает в базе синтетическую компанию с большим объемом данных. Запустите с --yes на тестовой базе.")
+        return 2
+
+    main.Base.metadata.create_all(bind=main.engine)
+    ensure_party_stats()
+    ensure_hot_filter_indexes()
+
+    db = SessionLocal()
+    tenant = None
+    failures = 0
+    try:
+        print(f"Наполнение: {args.orders} заказов, {args.clients} клиентов, {args.days} дней истории...")
+        tenant = seed_tenant(db, args.orders, args.clients, args.days)
+        print(f"Компания ID={tenant.company_id}\n")
+
+        client = None
+        if not args.skip_latency:
+            from fastapi.testclient import TestClient
+            client = TestClient(main.app) # Без with: startup-хуки (воркер и т.д.) не нужны
+
+        for case in HOT_CASES:
+            problems = check_plan(explain(db, case.statement(db, tenant)), case)
+            db.rollback() # Чтобы EXPLAIN не держал транзакцию между кейсами
+            line = f"[{'FAIL' if problems else ' OK '}] {case.name}"
+            if client is not None:
+                timings, error = measure(client, case, tenant, args.repeat)
+                budget = case.budget_ms * args.budget_scale
+                if error:
+                    problems.append(error)
+                else:
+                    p50, p95 = statistics.median(timings), percentile(timings, 0.95)
+                    line += f"  p50={p50:.1f}ms p95={p95:.1f}ms (бюджет {budget:.0f}ms)"
+                    if p95 > budget:
+                        problems.append(f"p95 {p95:.1f}ms > бюджета {budget:.0f}ms")
+                line = f"[{'FAIL' if problems else ' OK '}]" + line[6:]
+            print(line)
+            for problem in problems:
+                print(f"       - {problem}")
+            failures += bool(problems)
+    finally:
+        db.rollback()
+        if tenant is not None and not args.keep:
+            cleanup_tenant(db, tenant)
+            print("\nСинтетическая компания удалена.")
+        db.close()
+
+    print(f"\nИтого: {len(HOT_CASES) - failures} OK, {failures} FAIL")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
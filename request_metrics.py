@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# request_metrics.py
+# Метрики запросов API: задержка по маршрутам, число SQL-запросов и время БД на запрос,
+# ожидание соединения из пула. Отдаются в текстовом формате Prometheus (GET /metrics в main.py).
+#
+# Как считается:
+#   - RequestMetricsMiddleware (чистый ASGI, без BaseHTTPMiddleware) заводит RequestStats на запрос
+#     в contextvar; время фиксируется, когда ушел последний кусок ответа (BackgroundTasks не считаются);
+#   - instrument_engine() вешает события SQLAlchemy before/after_cursor_execute: каждый запрос к БД
+#     прибавляется к RequestStats текущего HTTP-запроса (или к "background", если запроса нет);
+#   - timed_pool_class() - пул, который меряет, сколько ждали соединение (pool_size/max_overflow кончились).
+# Медленные запросы (дольше SLOW_REQUEST_MS) пишутся в лог вместе с самыми долгими SQL.
+#
+# Отдельная библиотека (prometheus_client) не нужна: формат простой, метрик немного.
+
+import os
+import logging
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ ---
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+SLOW_REQUEST_TOP_QUERIES = 5
+MAX_RECORDED_STATEMENTS = 200 # На запрос храним не больше стольких SQL (для лога медленных)
+STATEMENT_LOG_LENGTH = 300
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+
+# --- ХРАНИЛИЩЕ МЕТРИК ---
+class Histogram:
+    """Гистограмма с фиксированными границами; значения по наборам меток."""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {} # [счетчики по бакетам..., сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            base = _format_labels(self.label_names, labels)
+            suffix = f"{{{base}}}" if base else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_join_labels(base, _le_label(_format_number(bound)))} {count}")
+            lines.append(f"{self.name}_bucket{_join_labels(base, _le_label('+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{suffix} {_format_number(series[-2])}")
+            lines.append(f"{self.name}_count{suffix} {series[-1]}")
+        return lines
+
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...], amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            base = _format_labels(self.label_names, labels)
+            suffix = f"{{{base}}}" if base else ""
+            lines.append(f"{self.name}{suffix} {_format_number(value)}")
+        return lines
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values))
+
+
+def _le_label(bound: str) -> str:
+    return f'le="{bound}"'
+
+
+def _join_labels(base: str, extra: str) -> str:
+    return f"{{{base},{extra}}}" if base else f"{{{extra}}}"
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not float(value).is_integer() else str(int(value))
+
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Время ответа API по маршрутам",
+    ("method", "route", "status"), LATENCY_BUCKETS,
+)
+REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements", "Число SQL-запросов на один HTTP-запрос",
+    ("method", "route"), STATEMENT_COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Суммарное время SQL-запросов на один HTTP-запрос",
+    ("method", "route"), LATENCY_BUCKETS,
+)
+DB_STATEMENTS_TOTAL = CounterMetric(
+    "db_statements_total", "Все SQL-запросы (source: request - из HTTP-запроса, background - воркер/старт)",
+    ("pool", "source"),
+)
+DB_STATEMENT_SECONDS_TOTAL = CounterMetric(
+    "db_statement_seconds_total", "Суммарное время SQL-запросов",
+    ("pool", "source"),
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Ожидание соединения из пула (включая открытие нового соединения)",
+    ("pool",), POOL_WAIT_BUCKETS,
+)
+POOL_TIMEOUTS_TOTAL = CounterMetric(
+    "db_pool_timeouts_total", "Сколько раз соединение из пула не дождались (pool_timeout)",
+    ("pool",),
+)
+SLOW_REQUESTS_TOTAL = CounterMetric(
+    "http_slow_requests_total", "Запросы дольше SLOW_REQUEST_MS",
+    ("method", "route"),
+)
+
+
+# --- СТАТИСТИКА ОДНОГО ЗАПРОСА ---
+@dataclass
+class RequestStats:
+    statement_count: int = 0
+    db_seconds: float = 0.0
+    statements: List[Tuple[float, str]] = field(default_factory=list) # (секунды, SQL)
+    finished: bool = False # После ответа (BackgroundTasks) запросы к БД уже не относим к нему
+
+
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar("request_metrics_current", default=None)
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _current_request.get()
+
+
+# --- SQLALCHEMY: СОБЫТИЯ И ПУЛ ---
+_instrumented_pools: List[Tuple[str, "weakref.ref"]] = []
+_pools_lock = threading.Lock()
+
+
+def instrument_engine(engine, pool_name: str) -> None:
+    """
+    Считает SQL-запросы движка. Для AsyncEngine передавайте engine.sync_engine.
+    Пул движка попадает в метрики /metrics (размер, занято, overflow).
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("metrics_query_start")
+        if not starts:
+            return
+        _record_statement(pool_name, statement, perf_counter() - starts.pop())
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        conn = exception_context.connection
+        starts = conn.info.get("metrics_query_start") if conn is not None else None
+        if starts:
+            _record_statement(pool_name, exception_context.statement or "", perf_counter() - starts.pop())
+
+    with _pools_lock:
+        _instrumented_pools.append((pool_name, weakref.ref(engine)))
+
+
+def _record_statement(pool_name: str, statement: str, seconds: float) -> None:
+    stats = _current_request.get()
+    if stats is not None and not stats.finished:
+        stats.statement_count += 1
+        stats.db_seconds += seconds
+        if len(stats.statements) < MAX_RECORDED_STATEMENTS:
+            stats.statements.append((seconds, statement))
+        source = "request"
+    else:
+        source = "background"
+    DB_STATEMENTS_TOTAL.inc((pool_name, source))
+    DB_STATEMENT_SECONDS_TOTAL.inc((pool_name, source), seconds)
+
+
+def timed_pool_class(base, pool_name: str):
+    """
+    Подкласс пула (QueuePool / AsyncAdaptedQueuePool), который меряет ожидание соединения.
+    Использование: create_engine(url, poolclass=timed_pool_class(QueuePool, "main"), ...)
+    """
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return base._do_get(self)
+        except PoolTimeoutError:
+            POOL_TIMEOUTS_TOTAL.inc((pool_name,))
+            raise
+        finally:
+            POOL_CHECKOUT_WAIT.observe((pool_name,), perf_counter() - start)
+
+    # __module__ базового пула: логгер пула остается в иерархии sqlalchemy.pool (и ее уровне логирования)
+    return type(f"Timed{base.__name__}", (base,), {"_do_get": _do_get, "__module__": base.__module__})
+
+
+def _render_pool_gauges() -> List[str]:
+    """Текущее состояние пулов: размер, занятые соединения, overflow (сумма по движкам одного имени)."""
+    totals: Dict[str, Counter] = {}
+    with _pools_lock:
+        alive = [(name, ref) for name, ref in _instrumented_pools if ref() is not None]
+        _instrumented_pools[:] = alive
+    for name, ref in alive:
+        pool = ref().pool
+        if not hasattr(pool, "checkedout"):
+            continue
+        values = totals.setdefault(name, Counter())
+        values["size"] += pool.size()
+        values["checked_out"] += pool.checkedout()
+        values["overflow"] += max(pool.overflow(), 0)
+        values["max_overflow"] += getattr(pool, "_max_overflow", 0)
+
+    lines = []
+    for metric, help_text in (
+        ("size", "Настроенный pool_size"),
+        ("checked_out", "Соединения, выданные сейчас"),
+        ("overflow", "Соединения сверх pool_size, открытые сейчас"),
+        ("max_overflow", "Настроенный max_overflow"),
+    ):
+        lines += [f"# HELP db_pool_{metric} {help_text}", f"# TYPE db_pool_{metric} gauge"]
+        for name in sorted(totals):
+            lines.append(f'db_pool_{metric}{{pool="{_escape_label(name)}"}} {totals[name][metric]}')
+    return lines
+
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus (version 0.0.4)."""
+    lines: List[str] = []
+    for metric in (REQUEST_LATENCY, REQUEST_DB_STATEMENTS, REQUEST_DB_SECONDS, SLOW_REQUESTS_TOTAL,
+                   DB_STATEMENTS_TOTAL, DB_STATEMENT_SECONDS_TOTAL, POOL_CHECKOUT_WAIT, POOL_TIMEOUTS_TOTAL):
+        lines += metric.render()
+    lines += _render_pool_gauges()
+    return "\n".join(lines) + "\n"
+
+
+# --- ASGI MIDDLEWARE ---
+class RequestMetricsMiddleware:
+    """
+    Меряет каждый HTTP-запрос. Маршрут берется шаблоном (/api/orders/{order_id}), а не фактическим путем,
+    чтобы число рядов в метриках не росло с каждым id. Неизвестные пути - '<unmatched>'.
+    """
+
+    def __init__(self, app, slow_request_ms: float = SLOW_REQUEST_MS):
+        self.app = app
+        self.slow_request_seconds = slow_request_ms / 1000
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        start = perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False) and not stats.finished:
+                self._finish(scope, stats, status_code, perf_counter() - start)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not stats.finished: # Ошибка до отправки ответа
+                self._finish(scope, stats, status_code, perf_counter() - start)
+            _current_request.reset(token)
+
+    def _finish(self, scope, stats: RequestStats, status_code: int, seconds: float) -> None:
+        stats.finished = True
+        route = scope.get("route")
+        route_path = getattr(route, "path", None) or "<unmatched>"
+        method = scope.get("method", "")
+        REQUEST_LATENCY.observe((method, route_path, str(status_code)), seconds)
+        REQUEST_DB_STATEMENTS.observe((method, route_path), stats.statement_count)
+        REQUEST_DB_SECONDS.observe((method, route_path), stats.db_seconds)
+        if seconds >= self.slow_request_seconds:
+            SLOW_REQUESTS_TOTAL.inc((method, route_path))
+            log_slow_request(method, scope.get("path", ""), status_code, seconds, stats)
+
+
+def log_slow_request(method: str, path: str, status_code: int, seconds: float, stats: RequestStats) -> None:
+    """Пишет в лог медленный запрос: самые долгие SQL и самый частый SQL (подсказка на N+1)."""
+    lines = [
+        f"[SLOW] {method} {path} -> {status_code} за {seconds * 1000:.0f} мс; "
+        f"SQL: {stats.statement_count} шт., {stats.db_seconds * 1000:.0f} мс"
+    ]
+    for duration, statement in sorted(stats.statements, key=lambda item: item[0], reverse=True)[:SLOW_REQUEST_TOP_QUERIES]:
+        lines.append(f"    {duration * 1000:.1f} мс: {_compact_sql(statement)}")
+    if stats.statements:
+        statement, repeats = Counter(statement for _, statement in stats.statements).most_common(1)[0]
+        if repeats > 1:
+            lines.append(f"    повторялся {repeats} раз: {_compact_sql(statement)}")
+    logger.warning("\n".join(lines))
+
+
+def _compact_sql(statement: str) -> str:
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= STATEMENT_LOG_LENGTH else statement[:STATEMENT_LOG_LENGTH] + "..."
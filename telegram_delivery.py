@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# telegram_delivery.py
+# Очередь доставки Telegram-сообщений (по одной на токен бота компании).
+#
+# Зачем: раньше каждое уведомление создавало новый telegram.Bot (новый HTTP-клиент),
+# а массовые рассылки шли по одному сообщению с фиксированной паузой 0.05 сек.
+# Здесь:
+#   - один Bot (и один пул HTTP-соединений) на токен;
+#   - token bucket на весь бот (лимит Telegram ~30 сообщений/сек)
+#     и отдельный интервал на каждый чат (~1 сообщение/сек в один чат);
+#   - ограниченная параллельность (семафор);
+#   - повторы: RetryAfter (флуд-контроль) ставит на паузу ВЕСЬ бот на указанное время,
+#     сетевые ошибки/таймауты - экспоненциальная задержка;
+#   - каждый результат возвращается как DeliveryOutcome (main.py пишет их в telegram_deliveries).
+
+import os
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+import telegram
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ (можно переопределить через .env) ---
+GLOBAL_MESSAGES_PER_SECOND = float(os.getenv("TG_GLOBAL_RATE", "25"))   # Запас от лимита Telegram в 30/сек
+PER_CHAT_INTERVAL_SECONDS = float(os.getenv("TG_PER_CHAT_INTERVAL", "1.0"))
+MAX_CONCURRENT_SENDS = int(os.getenv("TG_MAX_CONCURRENCY", "16"))
+MAX_ATTEMPTS = int(os.getenv("TG_MAX_ATTEMPTS", "4"))
+BASE_BACKOFF_SECONDS = 0.5
+# Адрес Bot API. Для нагрузочных тестов указывает на локальный fake_telegram.py
+TG_API_BASE_URL = os.getenv("TG_API_BASE_URL", "https://api.telegram.org/bot")
+TG_API_FILE_URL = os.getenv("TG_API_FILE_URL", "https://api.telegram.org/file/bot")
+
+
+@dataclass(frozen=True)
+class OutgoingMessage:
+    """Одно сообщение к отправке. client_id нужен только для журнала доставок."""
+    chat_id: str
+    text: str
+    photo_id: Optional[str] = None
+    reply_markup: Any = None
+    parse_mode: Optional[str] = "HTML"
+    disable_web_page_preview: bool = True
+    client_id: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class DeliveryOutcome:
+    """Результат доставки одного сообщения."""
+    chat_id: str
+    client_id: Optional[int]
+    ok: bool
+    attempts: int
+    message_id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramDeliveryQueue:
+    """
+    Отправитель для ОДНОГО токена бота. Создается через get_delivery_queue(token),
+    живет весь процесс и переиспользует HTTP-соединения.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        bot: Optional[telegram.Bot] = None,
+        global_rate: float = GLOBAL_MESSAGES_PER_SECOND,
+        per_chat_interval: float = PER_CHAT_INTERVAL_SECONDS,
+        concurrency: int = MAX_CONCURRENT_SENDS,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.token = token
+        if bot is None:
+            # get_updates очереди не нужен: один пул и для него, чтобы close() закрывал все соединения
+            request = HTTPXRequest(connection_pool_size=concurrency, read_timeout=15.0, write_timeout=15.0)
+            bot = telegram.Bot(
+                token=token,
+                base_url=TG_API_BASE_URL,
+                base_file_url=TG_API_FILE_URL,
+                request=request,
+                get_updates_request=request
+            )
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self._bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chat_next_send: Dict[str, float] = {}
+        self._chat_lock = asyncio.Lock()
+        self._paused_until = 0.0
+
+    # --- Ограничения скорости ---
+
+    async def _wait_flood_pause(self) -> None:
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _wait_chat_slot(self, chat_id: str) -> None:
+        """Не чаще одного сообщения в per_chat_interval в один и тот же чат."""
+        async with self._chat_lock:
+            now = time.monotonic()
+            slot = max(now, self._chat_next_send.get(chat_id, 0.0))
+            self._chat_next_send[chat_id] = slot + self.per_chat_interval
+            # Чистим старые записи, чтобы словарь не рос бесконечно
+            if len(self._chat_next_send) > 10000:
+                self._chat_next_send = {c: t for c, t in self._chat_next_send.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    # --- Отправка ---
+
+    async def _send_once(self, message: OutgoingMessage):
+        if message.photo_id:
+            return await self.bot.send_photo(
+                chat_id=message.chat_id,
+                photo=message.photo_id,
+                caption=message.text,
+                parse_mode=message.parse_mode,
+                reply_markup=message.reply_markup
+            )
+        return await self.bot.send_message(
+            chat_id=message.chat_id,
+            text=message.text,
+            parse_mode=message.parse_mode,
+            disable_web_page_preview=message.disable_web_page_preview,
+            reply_markup=message.reply_markup
+        )
+
+    async def send(self, message: OutgoingMessage) -> DeliveryOutcome:
+        """Отправляет одно сообщение с учетом лимитов и повторов. Никогда не бросает исключение."""
+        attempts = 0
+        last_error = None
+        # Ждем слот чата ДО семафора, чтобы частые сообщения в один чат не занимали все потоки отправки
+        await self._wait_chat_slot(message.chat_id)
+        async with self._semaphore:
+            while attempts < self.max_attempts:
+                attempts += 1
+                await self._wait_flood_pause()
+                await self._bucket.acquire()
+                try:
+                    sent = await self._send_once(message)
+                    return DeliveryOutcome(
+                        chat_id=message.chat_id, client_id=message.client_id, ok=True,
+                        attempts=attempts, message_id=getattr(sent, "message_id", None)
+                    )
+                except RetryAfter as e:
+                    # Флуд-контроль касается всего бота: ставим на паузу все отправки этого токена
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    last_error = f"RetryAfter {retry_after}s"
+                    logger.warning(f"[TG Delivery] Флуд-контроль (...{self.token[-4:]}): пауза {retry_after} сек.")
+                except (Forbidden, BadRequest) as e:
+                    # Бот заблокирован / чат не найден / неверный HTML - повтор не поможет
+                    last_error = f"{type(e).__name__}: {e}"
+                    break
+                except (TimedOut, NetworkError) as e:
+                    last_error = f"{type(e).__name__}: {e}"
+                    await asyncio.sleep(BASE_BACKOFF_SECONDS * (2 ** (attempts - 1)))
+                except Exception as e:
+                    last_error = f"{type(e).__name__}: {e}"
+                    break
+
+        logger.warning(f"[TG Delivery] Не доставлено в chat_id {message.chat_id} после {attempts} попыток: {last_error}")
+        return DeliveryOutcome(
+            chat_id=message.chat_id, client_id=message.client_id, ok=False,
+            attempts=attempts, error=last_error
+        )
+
+    async def send_many(self, messages: Iterable[OutgoingMessage]) -> List[DeliveryOutcome]:
+        """Отправляет пачку сообщений параллельно (в пределах семафора и лимитов)."""
+        return list(await asyncio.gather(*(self.send(m) for m in messages)))
+
+    async def close(self) -> None:
+        """Закрывает HTTP-соединения бота. Вызывать в том же event loop, где очередь отправляла."""
+        request = getattr(self.bot, "request", None)
+        if request is not None:
+            await request.shutdown()
+
+
+# --- РЕЕСТР ОЧЕРЕДЕЙ (одна на токен и event loop) ---
+_queues: Dict[str, TelegramDeliveryQueue] = {}
+_queue_loops: Dict[str, asyncio.AbstractEventLoop] = {}
+
+
+def _retire_queue(queue: Optional[TelegramDeliveryQueue], loop) -> None:
+    """
+    Прежняя очередь токена из другого event loop. Ее соединения привязаны к тому loop, поэтому
+    закрываем их на нем, если он еще работает (в другом потоке); иначе соединения уже мертвы
+    и очередь просто отпускаем.
+    """
+    if queue is None:
+        return
+    if loop is not None and loop.is_running() and not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(queue.close(), loop)
+    else:
+        logger.info(f"[TG Delivery] Event loop сменился: прежняя очередь токена ...{queue.token[-4:]} отпущена вместе с остановленным loop.")
+
+
+def get_delivery_queue(token: str) -> TelegramDeliveryQueue:
+    """Возвращает общую очередь для токена (создает при первом обращении)."""
+    loop = asyncio.get_running_loop()
+    queue = _queues.get(token)
+    # HTTP-клиент привязан к event loop: в другом loop (например, в воркере) создаем свою очередь
+    if queue is None or _queue_loops.get(token) is not loop:
+        _retire_queue(queue, _queue_loops.get(token))
+        queue = TelegramDeliveryQueue(token)
+        _queues[token] = queue
+        _queue_loops[token] = loop
+    return queue
+
+
+def register_delivery_queue(queue: TelegramDeliveryQueue) -> None:
+    """Подменяет очередь для токена (например, с фейковым Bot для локальных тестов)."""
+    previous = _queues.get(queue.token)
+    if previous is not None and previous is not queue:
+        _retire_queue(previous, _queue_loops.get(queue.token))
+    _queues[queue.token] = queue
+    _queue_loops[queue.token] = asyncio.get_running_loop()
+
+
+async def close_delivery_queues() -> None:
+    """Закрывает очереди текущего event loop и убирает их из реестра (при остановке API или воркера)."""
+    loop = asyncio.get_running_loop()
+    tokens = [token for token, queue_loop in _queue_loops.items() if queue_loop is loop]
+    for token in tokens:
+        queue = _queues.pop(token, None)
+        _queue_loops.pop(token, None)
+        if queue is not None:
+            try:
+                await queue.close()
+            except Exception as e:
+                logger.warning(f"[TG Delivery] Не удалось закрыть очередь токена ...{token[-4:]}: {e}")